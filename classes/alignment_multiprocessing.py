@@ -10,10 +10,15 @@ import os
 import itertools
 import networkx as nx
 import math
-from classes.cosine_similarity import CosineSimilarity
+import numpy as np
+from classes.cosine_similarity import CosineSimilarity, similarity_floor
+from classes import embedding_server
+from classes.campaign_index import CampaignIndex
+from classes.node_index import NodeIndex, label_bit
 import concurrent.futures
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import time
+import heapq
 from typing import List
 from keys import Keys
 NUM_PROCESS = Keys.NUM_PROCESSES
@@ -23,9 +28,29 @@ import multiprocessing as mp
 procedure_mapper = proID_techID
 global bert_similarity
 try:    
-    bert_similarity = CosineSimilarity.from_pickle(os.path.join(Keys.CONTEXT_SIMILARITY_PATH,"all.pkl"))
+    bert_similarity = CosineSimilarity.from_file(os.path.join(Keys.CONTEXT_SIMILARITY_PATH,"all.npy"))
 except:
     bert_similarity = CosineSimilarity()
+# counters of the combination search of graph_alignment, per process
+search_stats = dict()
+def record_search_stats(stats: dict):
+    for k,v in stats.items():
+        search_stats[k] = search_stats.get(k, 0) + v
+def merge_search_stats(total: dict, stats: dict):
+    for k,v in stats.items():
+        total[k] = total.get(k, 0) + v
+    return total
+def print_search_stats(stats: dict):
+    if stats.get("skipped", 0) > 0:
+        print(f"prefilter: skipped {stats['skipped']} procedures (features {stats.get('skipped_features', 0)}, labels {stats.get('skipped_labels', 0)}, bound {stats.get('skipped_bound', 0)})")
+    if stats.get("clusters", 0) > 0:
+        print(f"clusters: {stats['clustered']} procedures in {stats['clusters']} clusters, members verified {stats.get('members_verified', 0)}, skipped {stats.get('members_skipped', 0)}, representatives replaced {stats.get('representatives_replaced', 0)}")
+    if stats.get("graphs", 0) > 0:
+        print(f"graphs: {stats['graphs']} unique of {stats['graphs'] + stats.get('graphs_reused', 0)} procedures")
+    if stats.get("procedures", 0) == 0:
+        return
+    print(f"search: {stats['procedures']} procedures, explored {stats['explored']} of {stats['combinations']} combinations, pruned {stats['pruned']}, truncated {stats['truncated']}")
+    print(f"edge scores: {stats['edge_misses']} computed, {stats['edge_hits']} reused")
 def check_texts_similarity_simple(texts1:list, texts2:list):
     flag = False
     for t1 in texts1:
@@ -55,20 +80,68 @@ def get_procedure_phrases( procedures:dict):
         for k,v in procedures.items():
             procedure_phrases.extend(v.phrases)
         return list(set(procedure_phrases))
-def alignment_(campaign: Campaign, procedure:Procedure, technique):
+def procedure_clusters(procedures: List[Procedure]):
+    """ group the procedures linked in similar_mapper (f1 >= 0.90), keeping the order of procedures
+        the first procedure of each cluster is its representative
+    """
+    index = {procedure.id: i for i, procedure in enumerate(procedures)}
+    parent = list(range(len(procedures)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, procedure in enumerate(procedures):
+        for id_ in similar_mapper.get(procedure.id, {}):
+            if id_ in index:
+                a, b = find(i), find(index[id_])
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+    clusters = dict()
+    for i, procedure in enumerate(procedures):
+        clusters.setdefault(find(i), []).append(procedure)
+    return list(clusters.values())
+def procedure_keys(procedures: dict):
+    """ keys of procedures, with the members of a cluster next to each other when Keys.ALIGNMENT_CLUSTERS is set
+        so that the slices given to alignment_with_range split as few clusters as possible
+    """
+    if not Keys.ALIGNMENT_CLUSTERS:
+        return list(procedures.keys())
+    return [procedure.id for cluster in procedure_clusters(list(procedures.values())) for procedure in cluster]
+def cluster_region(campaign: Campaign, rs: dict):
+    """ the campaign nodes of the sentences where alignment_ located a representative,
+        its cluster members are only aligned against them
+    """
+    if not rs:
+        return []
+    sent_indexes = [i for records in rs.values() for record in records for i in record["sent_indexes"]]
+    if len(sent_indexes) == 0:
+        return []
+    first, last = min(sent_indexes), max(sent_indexes)
+    return [k for k, i in CampaignIndex.get(campaign).sent_indexes.items() if first <= i <= last]
+def alignment_(campaign: Campaign, procedure:Procedure, technique, sub_graph: list = None, alignments: dict = None):
         features = technique.features
         rs = {}
-        if not hasattr(campaign, "nodeID_2_order") :
-            campaign.nodeID_2_order = {}
-            node_ids = list(campaign.graph_nodes.keys())
-            node_ids = sorted(node_ids)
-            for i in range(len(node_ids)):
-                campaign.nodeID_2_order[node_ids[i]] = i
         if len(procedure.graph_nodes) == 0 or len(procedure.graph_edges) == 0:
             return
-        sub_graph = list(campaign.graph_nodes.keys())
+        if sub_graph is None:
+            sub_graph = list(campaign.graph_nodes.keys())
 
-        max_value, max_combination = Alignment.graph_alignment(campaign,sub_graph, procedure)
+        if alignments is None:
+            max_value, max_combination = Alignment.graph_alignment(campaign,sub_graph, procedure)
+        else:
+            # procedures with the same graph hash share the alignment, the combination is kept by node position
+            if not hasattr(procedure, "graph_hash"):
+                procedure.graph_hash = procedure.get_graph_hash()
+            if procedure.graph_hash in alignments:
+                record_search_stats({"graphs_reused": 1})
+            else:
+                max_value, max_combination = Alignment.graph_alignment(campaign,sub_graph, procedure)
+                combination = None if max_combination is None else [max_combination[k] for k in procedure.graph_nodes.keys()]
+                alignments[procedure.graph_hash] = (max_value, combination)
+                record_search_stats({"graphs": 1})
+            max_value, combination = alignments[procedure.graph_hash]
+            max_combination = None if combination is None else dict(zip(procedure.graph_nodes.keys(), combination))
         #localize where the procedure is in the campaign
         # id_ = Alignment._get_id(max_combination, procedure, features)
         # if id_ != -1 and max_value > Keys.MATCHING_THRESHOLD:
@@ -77,7 +150,7 @@ def alignment_(campaign: Campaign, procedure:Procedure, technique):
         #         rs[order_id] = []
         #     print(f"procedure id : {procedure.id} \n max_value: {max_value} \n order_id : {order_id}")
         #     rs[order_id].append((procedure.id, max_value))
-        alignment_rs = Alignment.alignment_localization(max_combination, procedure, features, campaign.nodeID_2_order,campaign= campaign)
+        alignment_rs = Alignment.alignment_localization(max_combination, procedure, features, CampaignIndex.get(campaign).order,campaign= campaign)
         if alignment_rs != -1 and max_value > Keys.MATCHING_THRESHOLD:
             index = alignment_rs[0]
             if index not in rs:
@@ -111,22 +184,187 @@ def alignment_with_range(campaign: Campaign, procedures: List[Procedure], technq
     if Keys.MULTI_PROCESSING:
         if Keys.BERT_SIM_ENABLE and bert_BERT_path is not None:
             global bert_similarity
-            bert_similarity = CosineSimilarity.from_pickle(bert_BERT_path)
-    rs = {}
-    # if testing:
+            bert_similarity = CosineSimilarity.from_file(bert_BERT_path)
+    results, stats = alignment_with_targets([campaign], procedures, technqiques)
+    # print("alignment with range- multiprocessing-this process is done")
+    return results[0], stats[0]
+
+def alignment_with_targets(campaigns: List[Campaign], procedures: List[Procedure], technqiques: dict):
+    """ align every procedure with every campaign chunk, procedure by procedure,
+        so the setup of a procedure (node index, phrase indices, graph hash) is done once for all chunks
+        the prefilter runs per chunk and the clusters of a chunk are formed from the procedures passing it, as for a single chunk
+        return one rs and one search stats per campaign
+    """
+    global search_stats
+    results = [dict() for _ in campaigns]
+    chunk_stats = [dict() for _ in campaigns]
+    alignments = [dict() for _ in campaigns] # graph hash -> alignment, per campaign
+    procedures = [procedure for procedure in procedures if len(procedure.graph_nodes) >= 2]
+    stats = search_stats
+    try:
+        chunk_clusters = [] # representative id -> cluster, per campaign
+        for index, campaign in enumerate(campaigns):
+            search_stats = chunk_stats[index]
+            chunk_clusters.append({cluster[0].id: cluster for cluster in prefiltered_clusters(campaign, procedures, technqiques)})
+        # the clusters of a chunk are aligned when the loop reaches their representative, so they keep their order in every chunk
+        for procedure in procedures:
+            for index, campaign in enumerate(campaigns):
+                cluster = chunk_clusters[index].get(procedure.id)
+                if cluster is None:
+                    continue
+                # the counters of the search go to the stats of this campaign
+                search_stats = chunk_stats[index]
+                alignment_cluster(campaign, cluster, technqiques, alignments[index], results[index])
+    finally:
+        search_stats = stats
+    return results, chunk_stats
 
+def prefiltered_clusters(campaign: Campaign, procedures: List[Procedure], technqiques: dict):
+    """ the procedures passing the prefilter in campaign, grouped by procedure_clusters when Keys.ALIGNMENT_CLUSTERS is set
+    """
+    aligned = []
     for procedure in procedures:
-        if len(procedure.graph_nodes) <2:
+        if Keys.ALIGNMENT_PREFILTER:
+            reason = Alignment.prefilter(campaign, procedure, technqiques[procedure.special_id].features)
+            if reason is not None:
+                record_search_stats({"skipped": 1, "skipped_" + reason: 1})
+                continue
+        aligned.append(procedure)
+    if Keys.ALIGNMENT_CLUSTERS:
+        clusters = procedure_clusters(aligned)
+        record_search_stats({"clusters": len(clusters), "clustered": len(aligned)})
+    else:
+        clusters = [[procedure] for procedure in aligned]
+    return clusters
+
+def scored_below_threshold(procedure: Procedure, alignments: dict):
+    """ whether alignment_ aligned procedure (its graph_alignment is in alignments) and the best score is not above MATCHING_THRESHOLD
+    """
+    alignment = alignments.get(getattr(procedure, "graph_hash", None))
+    return alignment is not None and alignment[0] <= Keys.MATCHING_THRESHOLD
+def alignment_cluster(campaign: Campaign, cluster: List[Procedure], technqiques: dict, alignments: dict, rs: dict):
+    """ alignment_ of the procedures of a cluster in campaign, added to rs
+        the representative is aligned with the whole campaign, the other procedures where it was located.
+        a representative rejected for its own graph (no edges, only ACTOR and USER located, ...) says nothing about the members,
+        the next member takes its place
+    """
+    sub_graph = None
+    for procedure in cluster:
+        if sub_graph is not None and len(sub_graph) == 0:
+            # the representative was not located, neither are its members
+            record_search_stats({"members_skipped": 1})
             continue
-        rs_ = alignment_(campaign, procedure, technqiques[procedure.special_id])
+        rs_ = alignment_(campaign, procedure, technqiques[procedure.special_id], sub_graph, alignments if sub_graph is None else None)
+        if sub_graph is None:
+            if rs_ or scored_below_threshold(procedure, alignments):
+                sub_graph = cluster_region(campaign, rs_)
+            else:
+                record_search_stats({"representatives_replaced": 1})
+        else:
+            record_search_stats({"members_verified": 1})
         if rs_ is None:
             continue
         for k,v in rs_.items():
             if k not in rs:
                 rs[k] = list()
             rs[k].extend(v)
-    # print("alignment with range- multiprocessing-this process is done")
-    return rs
+
+# read-only state of an alignment worker, set once per process by init_alignment_worker
+worker_procedures = dict()
+worker_techniques = dict()
+worker_chunks = dict()
+worker_similarity_path = None
+def campaign_chunks(reports: list):
+    """ (report id, chunk index) -> campaign chunk, for every chunk of reports (BigCampaign, or Campaign as its only chunk)
+    """
+    chunks = dict()
+    for report in reports:
+        for index, campaign in enumerate(report.data if isinstance(report, BigCampaign) else [report]):
+            chunks[(report.id, index)] = campaign
+    return chunks
+def init_alignment_worker(procedures: dict, techniques: dict, chunks: dict = None):
+    """ initializer of the alignment pool, the procedures, techniques and campaign chunks reach each worker once
+        instead of with every task, the tasks only carry procedure ids and chunk keys
+    """
+    global worker_procedures, worker_techniques, worker_chunks
+    worker_procedures = procedures
+    worker_techniques = techniques
+    worker_chunks = chunks if chunks is not None else dict()
+def alignment_pool(procedures: dict, techniques: dict, chunks: dict = None):
+    """ worker pool of the alignment, started once per run and given to the all_alignment_* drivers
+        chunks: campaign_chunks of every report the pool will align
+    """
+    # the workers connect to the embedding server started here instead of racing to start it
+    embedding_server.ensure_server()
+    return ProcessPoolExecutor(max_workers=NUM_PROCESS, initializer=init_alignment_worker, initargs=(procedures, techniques, chunks))
+def load_worker_similarity(bert_BERT_path: str):
+    """ memory-map the similarity store of bert_BERT_path, once per worker and file instead of once per task
+    """
+    global bert_similarity, worker_similarity_path
+    if Keys.BERT_SIM_ENABLE and bert_BERT_path is not None and bert_BERT_path != worker_similarity_path:
+        bert_similarity = CosineSimilarity.from_file(bert_BERT_path)
+        worker_similarity_path = bert_BERT_path
+def alignment_with_ids(chunk_key: tuple, procedure_ids: list, bert_BERT_path:str = None):
+    """ alignment_with_range of the procedures procedure_ids with the chunk chunk_key in a worker of alignment_pool
+        return rs, search stats and (pid, busy seconds) of the worker
+    """
+    start = time.time()
+    load_worker_similarity(bert_BERT_path)
+    rs, stats = alignment_with_range(worker_chunks[chunk_key], [worker_procedures[k] for k in procedure_ids], worker_techniques)
+    return rs, stats, (os.getpid(), time.time() - start)
+def alignment_with_target_ids(chunk_keys: list, procedure_ids: list, bert_BERT_path:str = None):
+    """ alignment_with_targets of the procedures procedure_ids with the chunks chunk_keys in a worker of alignment_pool
+        return one rs and one search stats per chunk, and (pid, busy seconds) of the worker
+    """
+    start = time.time()
+    load_worker_similarity(bert_BERT_path)
+    results, stats = alignment_with_targets([worker_chunks[k] for k in chunk_keys], [worker_procedures[k] for k in procedure_ids], worker_techniques)
+    return results, stats, (os.getpid(), time.time() - start)
+def procedure_cost(procedure: Procedure, campaign_index: CampaignIndex):
+    """ estimated cost of alignment_ for procedure in a campaign chunk:
+        the node similarities to every chunk node, plus the edges scored over the candidate combinations,
+        taking the chunk nodes that share a label with a node (at most 30) as its candidates
+    """
+    combinations = 1
+    for node in procedure.graph_nodes.values():
+        shared = sum(len(campaign_index.label_nodes.get(label, [])) for label in node["meta"]["label"])
+        combinations *= max(1, min(30, shared))
+    return len(procedure.graph_nodes) * len(campaign_index) + len(procedure.graph_edges) * min(combinations, Keys.ALIGNMENT_MAX_COMBINATIONS)
+def procedure_tasks(campaigns: List[Campaign], procedures: dict, keys: list):
+    """ split keys into the tasks of campaigns, NUM_PROCESS * ALIGNMENT_TASKS_PER_PROCESS tasks of about the same procedure_cost
+        packed longest first, so that the workers finish together and small tasks keep streaming through as_completed
+        procedures sharing a graph hash (or a cluster) stay in one task, where their alignment is reused
+    """
+    if Keys.ALIGNMENT_TASKS_PER_PROCESS <= 0:
+        return [keys[i:i+NUM_PROCEDURES_PER_PROCESS] for i in range(0, len(keys), NUM_PROCEDURES_PER_PROCESS)]
+    campaign_indexes = [CampaignIndex.get(campaign) for campaign in campaigns]
+    if Keys.ALIGNMENT_CLUSTERS:
+        units = [[procedure.id for procedure in cluster] for cluster in procedure_clusters([procedures[k] for k in keys])]
+    else:
+        units = dict()
+        for k in keys:
+            if not hasattr(procedures[k], "graph_hash"):
+                procedures[k].graph_hash = procedures[k].get_graph_hash()
+            units.setdefault(procedures[k].graph_hash, []).append(k)
+        units = list(units.values())
+    costs = []
+    for unit in units:
+        # one alignment per graph hash of the unit
+        hashes = {getattr(procedures[k], "graph_hash", k): k for k in unit}
+        costs.append(sum(procedure_cost(procedures[k], campaign_index) for k in hashes.values() for campaign_index in campaign_indexes))
+    n_tasks = min(len(units), NUM_PROCESS * Keys.ALIGNMENT_TASKS_PER_PROCESS)
+    tasks = [(0, i, []) for i in range(n_tasks)]
+    for u in sorted(range(len(units)), key=lambda u: costs[u], reverse=True):
+        cost, i, task = heapq.heappop(tasks)
+        task.extend(units[u])
+        heapq.heappush(tasks, (cost + costs[u], i, task))
+    position = {k: i for i, k in enumerate(keys)}
+    return [sorted(task, key=lambda k: position[k]) for cost, i, task in sorted(tasks, reverse=True) if len(task) > 0]
+def print_worker_stats(worker_busy: dict, seconds: float):
+    """ busy and idle time of every worker that ran a task during seconds
+    """
+    for pid, busy in sorted(worker_busy.items()):
+        print(f"worker {pid}: busy {busy:.1f}s, idle {max(0.0, seconds - busy):.1f}s")
 
 class Alignment():
     @classmethod
@@ -338,10 +576,51 @@ class Alignment():
                 max_combination = _mapper
         return max_value, max_combination
     @classmethod
+    def prefilter(cls, campaign: Campaign, procedure: Procedure, features: list):
+        """ whether alignment_ can record procedure in campaign, from the labels only (no text similarity)
+            a procedure node has no similar node when it is gated and no campaign node shares one of its labels,
+            every other node is taken as similar (1.0) to bound the score of graph_alignment from above
+            return None when it can, otherwise why it cannot: "features", "labels" or "bound"
+        """
+        if len(features) == 0:
+            return "features" # alignment_localization never locates it
+        campaign_index = CampaignIndex.get(campaign)
+        if not hasattr(procedure, "node_index"):
+            procedure.node_index = NodeIndex(procedure)
+        possible = dict()
+        for k in procedure.graph_nodes.keys():
+            labels = procedure.graph_nodes[k]["meta"]["label"]
+            shared = any(label in campaign_index.label_nodes for label in labels)
+            if procedure.node_index.gated[procedure.node_index.position[k]]:
+                possible[k] = shared
+            else:
+                possible[k] = shared or campaign_index.ungated > 0
+        # ACTOR-only and OTHER-only nodes are neither located nor counted in the node similarity
+        counted = dict()
+        for k in procedure.graph_nodes.keys():
+            labels = procedure.graph_nodes[k]["meta"]["label"]
+            counted[k] = not (len(labels) == 1 and labels[0] in ["ACTOR", "OTHER"])
+        if not any(possible[k] and counted[k] for k in procedure.graph_nodes.keys()):
+            return "labels"
+        normalize_factor = len(procedure.graph_nodes) - sum(1 for k in procedure.graph_nodes.keys() if possible[k] and not counted[k])
+        if normalize_factor == 0:
+            normalize_factor = 1
+        bound = sum(1.0 for k in procedure.graph_nodes.keys() if possible[k] and counted[k]) / normalize_factor
+        edges = [e for e in procedure.graph_edges.values() if e["source"] in procedure.graph_nodes and e["dest"] in procedure.graph_nodes]
+        if len(edges) > 0:
+            # an edge is at most 1.0, and 0.0 when one of its ends has no similar node
+            bound = (bound + sum(1.0 for e in edges if possible[e["source"]] and possible[e["dest"]]) / len(edges)) / 2
+        else:
+            bound = bound / 2
+        if bound + 1e-9 <= Keys.MATCHING_THRESHOLD:
+            return "bound"
+        return None
+    @classmethod
     def graph_alignment(cls,campaign:Campaign, sub_graph:list , procedure: Procedure):
         all_result = []
         edge_alignment = {}
         node_alignment, node_matrix = Alignment.node_alignment(campaign, sub_graph, procedure)
+        campaign_index = CampaignIndex.get(campaign)
         #k_list is the list of nodes in procedure
         #prevent combination explosion
         for k,v in node_alignment.items():
@@ -352,162 +631,8 @@ class Alignment():
         k_list = list(node_alignment.keys())
         #v_list is the list, each element is a list of similar nodes in campaign
         v_list = list(node_alignment.values())
-        #generate all the posible subgraph combinations in campaign
-        counter = 0
-        max_value =0.0
-        max_combination  = None
-        # print("combinations: ", len(combinations))
-         # mapper will map a node_id in procedure to a (similar)node_id in campaign
-        for c in itertools.product(*v_list):
-            counter += 1
-            if counter > 20000:
-                break # too many combinations, we only consider the first 20000 combinations
-            # length of each c is the same as the number of keys (k_list) in the node_alignment
-            _mapper = {} 
-            for i in range(0, len(k_list)):
-                if c[i] == -1:
-                    # node i in this combination c, does not have a similar node in campaign
-                    _mapper[k_list[i]] = None
-                else:
-                    # k_list[i] is the node id in procedure
-                    # c[i] is the node id in campaign
-                    _mapper[k_list[i]] = c[i]
-            for k,v in procedure.graph_edges.items():
-                # we will check each edge in procedure
-                # we get edge source and dest node
-                procedure_source= v["source"]
-                procedure_dest = v["dest"]
-                if "verbs" in procedure.graph_nodes[procedure_dest]["meta"]:
-                    verbs = procedure.graph_nodes[procedure_dest]["meta"]["verbs"]
-                else:
-                    verb = v["verb"]
-                    if "verbs" in v:
-                        verbs = v["verbs"]
-                    else:
-                        verbs = [verb]
-                verbs = list(set(verbs))
-                verb_similarity = None
-                if procedure_source not in procedure.graph_nodes or procedure_dest not in procedure.graph_nodes:
-                    continue
-                try:
-                    if _mapper[procedure_source] is None or _mapper[procedure_dest] is None:
-                        # None meaning that this procedure node does not have a similar node in campaign
-                        edge_alignment[k] = 0.0
-                        continue
-                except:
-                    edge_alignment[k] = 0.0
-                    continue
-                # we find the similar node in campaign for the source and the dest
-                campaign_source = _mapper[procedure_source][0]
-                campaign_dest = _mapper[procedure_dest][0]
-                # we calculate the distance between the source and the dest in campaign
-
-                try:
-                        distance1 = nx.shortest_path_length(campaign.graph, campaign_source , campaign_dest)
-                except:
-                        #except mean that there is no path between source and dest
-                        distance1 = 100
-                verbs_2 = []
-                if campaign.graph_nodes[campaign_dest]["meta"]["type"]== "object":
-                    if "verbs" in campaign.graph_nodes[campaign_dest]["meta"]:
-                        verbs_2 = list(set(campaign.graph_nodes[campaign_dest]["meta"]["verbs"]))
-
-                else:
-                        verbs_2 = []
-                                # edge = None
-                                # id2 = str(campaign_source) + "_" + str(campaign_dest)
-                                # id2_ = str(campaign_dest) + "_" + str(campaign_source)
-                                # if id2 in campaign.graph_edges:
-                                #     edge = campaign.graph_edges[id2]
-                                # else:
-                                #     if id2_ in campaign.graph_edges:
-                                #         edge = campaign.graph_edges[id2_]
-                                # if edge is not None:            
-                                #     verb_2 = edge["verb"]
-                                #     if "verbs" in edge:
-                                #         verbs_2 = edge["verbs"]
-                                #     else:
-                                #         verbs_2 = [verb_2]
-                                # else:
-                if len(verbs) > 0 and len(verbs_2) ==0:
-                    if check_if_verb_is_strong(verbs):
-                            verb_similarity = Keys.VERB_DIFF_SEVERVE_PUNISHMENT
-                    else:
-                        if len(procedure.graph_nodes) == 2:
-                            verb_similarity = Keys.VERB_DIFF_PUNISHMENT #punish more
-                        if len(procedure.graph_nodes) > 2:
-                            verb_similarity = Keys.VERB_DIFF_SOFT_PUNISHMENT
-                if len(verbs) > 0 and len(verbs_2)> 0 and check_verbs_similarity(verbs, verbs_2): # apply verb similarity checking
-                    if len(procedure.graph_nodes) == 2:
-                        verb_similarity = 1.0 # this is a very good case 
-                    else:
-                        verb_similarity = 1.0
-                    # for v in imporant_verbs:
-                    #     if v in verbs and v in verbs_2:
-                    #         verb_similarity = 1.5
-                if len(verbs) > 0 and len(verbs_2) > 0 and verb_similarity is None:
-                                        #in this case, we have verbs information but they are very different, we need to pusnish the similarity
-                        if len(procedure.graph_nodes)==2:
-                            verb_similarity = Keys.VERB_DIFF_PUNISHMENT
-                        else:
-                            if check_strong_verb_similarity_mismatch(verbs, verbs_2):
-                                verb_similarity = Keys.VERB_DIFF_SEVERVE_PUNISHMENT
-                            else:
-                                verb_similarity = Keys.VERB_DIFF_SOFT_PUNISHMENT
-
-                distance = distance1
-                if distance > 1:                
-                    distance2 = Alignment.get_sent_distance(campaign.graph_nodes[campaign_source], campaign.graph_nodes[campaign_dest])
-                    distance = min(distance1,distance2)
-                # # we relaxed the distance since the coref between two nodes is not perfect
-                # # resulting in a large distance or even no path between two nodes
-                if (("ACTOR" in procedure.graph_nodes[procedure_source]["meta"]["label"] and len(procedure.graph_nodes[procedure_source]["meta"]["label"]) ==1 ) \
-                    or \
-                    ( "ACTOR" in procedure.graph_nodes[procedure_dest]["meta"]["label"] and len(procedure.graph_nodes[procedure_dest]["meta"]["label"]) ==1)):
-                    # or procedure.graph_nodes[procedure_source]["meta"]["text"] in malwares or procedure.graph_nodes[procedure_dest]["meta"]["text"] in malwares:
-
-                    distance = min(Keys.ACTOR_TOLERATE_DISTANCE, distance)
-                    if ("VULNERABILITY" in procedure.graph_nodes[procedure_source]["meta"]["label"] and len(procedure.graph_nodes[procedure_source]["meta"]["label"])==1) \
-                    or ("VULNERABILITY" in procedure.graph_nodes[procedure_dest]["meta"]["label"] and len(procedure.graph_nodes[procedure_dest]["meta"]["label"])==1):
-                        distance = 1.0
-                    if ("REGISTRY" in procedure.graph_nodes[procedure_source]["meta"]["label"] and len(procedure.graph_nodes[procedure_source]["meta"]["label"])==1) \
-                    or ("REGISTRY" in procedure.graph_nodes[procedure_dest]["meta"]["label"] and len(procedure.graph_nodes[procedure_dest]["meta"]["label"])==1):
-                        distance = 1.0
-                if campaign_source == campaign_dest: # avoid distance = 0
-                    distance = 1
-                #we extract the similarity value between the sources (one from procedure and one from campaign)
-                source_similarity_value = node_matrix[procedure_source][campaign_source]
-                #we extract the similarity value between the dests (one from procedure and one from campaign)
-                dest_similarity_value = node_matrix[procedure_dest][campaign_dest]
-                # we calculate the similarity value between the edge in procedure and the edge in campaign
-                edge_similarity_value = math.sqrt(source_similarity_value * dest_similarity_value) / distance
-                # if source_similarity_value >=1.0 and dest_similarity_value >=1.0 and campaign_source != campaign_dest:
-                #     edge_similarity_value = math.sqrt(edge_similarity_value)
-                
-                edge_alignment[k] = edge_similarity_value
-                if verb_similarity is not None:
-                    #if the verb is different, we decrease the edge similarity value
-                    if edge_similarity_value > verb_similarity and verb_similarity < 1.0:
-                        edge_alignment[k] = math.sqrt(edge_similarity_value * verb_similarity)
-                        #punishment
-                    # if the verb is the same, we increase the edge similarity value
-                    if verb_similarity >= 1.0:
-                        edge_alignment[k] = math.sqrt(edge_similarity_value * verb_similarity)
-                    if edge_alignment[k] >= 1.0:
-                        edge_alignment[k] = 1.0
-                
-                     # we save the edge similarity value into a dictionary
-            #now we calculate the similarity value between the procedure and its similar subgraph in campaign
-            _sub_graph_similarity = Alignment._sub_graph_alligment_score(_mapper, edge_alignment, procedure)
-            if _sub_graph_similarity >= 1.0:
-                _sub_graph_similarity = 1.0
-            if _sub_graph_similarity >= max_value:
-                # save the best subgraph
-                max_value = _sub_graph_similarity
-                max_combination = _mapper
-                temp_mapper = {k:v for k,v in _mapper.items() if not (len(procedure.graph_nodes[k]["meta"]["label"])==1 and "ACTOR" in procedure.graph_nodes[k]["meta"]["label"])}
-                if _sub_graph_similarity > Keys.MATCHING_THRESHOLD:
-                    all_result.append((_sub_graph_similarity,temp_mapper, _mapper))
+        #search the posible subgraph combinations in campaign
+        max_value, max_combination, all_result = Alignment._combination_search(campaign, procedure, k_list, v_list, node_matrix, campaign_index)
         if len(all_result) == 0:
             return max_value, max_combination
         all_result = sorted(all_result, key=lambda x: x[0], reverse=True)
@@ -520,43 +645,403 @@ class Alignment():
             return toprs[0][0], toprs[0][2]# 
         return max_value, max_combination
     @classmethod
+    def _edge_verbs(cls, procedure: Procedure, v: dict):
+        """ verbs of the procedure edge v (those of its dest when it has some) and their verbs_mask
+        """
+        procedure_dest = v["dest"]
+        if "verbs" in procedure.graph_nodes[procedure_dest]["meta"]:
+            verbs = procedure.graph_nodes[procedure_dest]["meta"]["verbs"]
+        else:
+            verb = v["verb"]
+            if "verbs" in v:
+                verbs = v["verbs"]
+            else:
+                verbs = [verb]
+        verbs = list(set(verbs))
+        return verbs, verbs_mask(verbs)
+
+    @classmethod
+    def _edge_verb_similarity(cls, campaign_index: CampaignIndex, procedure: Procedure, edge_verbs: tuple, campaign_dest):
+        """ verb agreement between a procedure edge and the campaign node chosen for its dest,
+            None when there is no verb information to compare
+            edge_verbs: Alignment._edge_verbs of the edge
+        """
+        verbs, mask = edge_verbs
+        verb_similarity = None
+        # verbs of the campaign dest, only object nodes carry them
+        verbs_2 = campaign_index.verbs.get(campaign_dest, [])
+        mask_2 = campaign_index.verb_masks.get(campaign_dest, 0)
+                        # edge = None
+                        # id2 = str(campaign_source) + "_" + str(campaign_dest)
+                        # id2_ = str(campaign_dest) + "_" + str(campaign_source)
+                        # if id2 in campaign.graph_edges:
+                        #     edge = campaign.graph_edges[id2]
+                        # else:
+                        #     if id2_ in campaign.graph_edges:
+                        #         edge = campaign.graph_edges[id2_]
+                        # if edge is not None:            
+                        #     verb_2 = edge["verb"]
+                        #     if "verbs" in edge:
+                        #         verbs_2 = edge["verbs"]
+                        #     else:
+                        #         verbs_2 = [verb_2]
+                        # else:
+        if len(verbs) > 0 and len(verbs_2) ==0:
+            if mask & strong_verb_mask:
+                    verb_similarity = Keys.VERB_DIFF_SEVERVE_PUNISHMENT
+            else:
+                if len(procedure.graph_nodes) == 2:
+                    verb_similarity = Keys.VERB_DIFF_PUNISHMENT #punish more
+                if len(procedure.graph_nodes) > 2:
+                    verb_similarity = Keys.VERB_DIFF_SOFT_PUNISHMENT
+        if len(verbs) > 0 and len(verbs_2)> 0 and check_verbs_similarity(verbs, verbs_2, mask, mask_2): # apply verb similarity checking
+            if len(procedure.graph_nodes) == 2:
+                verb_similarity = 1.0 # this is a very good case 
+            else:
+                verb_similarity = 1.0
+            # for v in imporant_verbs:
+            #     if v in verbs and v in verbs_2:
+            #         verb_similarity = 1.5
+        if len(verbs) > 0 and len(verbs_2) > 0 and verb_similarity is None:
+                                #in this case, we have verbs information but they are very different, we need to pusnish the similarity
+                if len(procedure.graph_nodes)==2:
+                    verb_similarity = Keys.VERB_DIFF_PUNISHMENT
+                else:
+                    if (mask ^ mask_2) & strong_verb_mask: # check_strong_verb_similarity_mismatch
+                        verb_similarity = Keys.VERB_DIFF_SEVERVE_PUNISHMENT
+                    else:
+                        verb_similarity = Keys.VERB_DIFF_SOFT_PUNISHMENT
+        return verb_similarity
+
+    @classmethod
+    def _edge_score(cls, campaign_index: CampaignIndex, procedure: Procedure, v: dict, campaign_source, campaign_dest, node_matrix: dict, verb_similarity):
+        """ similarity between the procedure edge v and the campaign nodes chosen for its source and dest,
+            verb_similarity is Alignment._edge_verb_similarity of the dest
+        """
+        procedure_source= v["source"]
+        procedure_dest = v["dest"]
+        # we calculate the distance between the source and the dest in campaign
+        # UNREACHABLE (100) means that there is no path between source and dest
+        distance1 = campaign_index.distances.hop_distance(campaign_source, campaign_dest)
+        distance = distance1
+        if distance > 1:                
+            distance2 = campaign_index.distances.sent_distance(campaign_source, campaign_dest)
+            distance = min(distance1,distance2)
+        # # we relaxed the distance since the coref between two nodes is not perfect
+        # # resulting in a large distance or even no path between two nodes
+        if (("ACTOR" in procedure.graph_nodes[procedure_source]["meta"]["label"] and len(procedure.graph_nodes[procedure_source]["meta"]["label"]) ==1 ) \
+            or \
+            ( "ACTOR" in procedure.graph_nodes[procedure_dest]["meta"]["label"] and len(procedure.graph_nodes[procedure_dest]["meta"]["label"]) ==1)):
+            # or procedure.graph_nodes[procedure_source]["meta"]["text"] in malwares or procedure.graph_nodes[procedure_dest]["meta"]["text"] in malwares:
+
+            distance = min(Keys.ACTOR_TOLERATE_DISTANCE, distance)
+            if ("VULNERABILITY" in procedure.graph_nodes[procedure_source]["meta"]["label"] and len(procedure.graph_nodes[procedure_source]["meta"]["label"])==1) \
+            or ("VULNERABILITY" in procedure.graph_nodes[procedure_dest]["meta"]["label"] and len(procedure.graph_nodes[procedure_dest]["meta"]["label"])==1):
+                distance = 1.0
+            if ("REGISTRY" in procedure.graph_nodes[procedure_source]["meta"]["label"] and len(procedure.graph_nodes[procedure_source]["meta"]["label"])==1) \
+            or ("REGISTRY" in procedure.graph_nodes[procedure_dest]["meta"]["label"] and len(procedure.graph_nodes[procedure_dest]["meta"]["label"])==1):
+                distance = 1.0
+        if campaign_source == campaign_dest: # avoid distance = 0
+            distance = 1
+        #we extract the similarity value between the sources (one from procedure and one from campaign)
+        source_similarity_value = node_matrix[procedure_source][campaign_source]
+        #we extract the similarity value between the dests (one from procedure and one from campaign)
+        dest_similarity_value = node_matrix[procedure_dest][campaign_dest]
+        # we calculate the similarity value between the edge in procedure and the edge in campaign
+        edge_similarity_value = math.sqrt(source_similarity_value * dest_similarity_value) / distance
+        # if source_similarity_value >=1.0 and dest_similarity_value >=1.0 and campaign_source != campaign_dest:
+        #     edge_similarity_value = math.sqrt(edge_similarity_value)
+        
+        edge_score = edge_similarity_value
+        if verb_similarity is not None:
+            #if the verb is different, we decrease the edge similarity value
+            if edge_similarity_value > verb_similarity and verb_similarity < 1.0:
+                edge_score = math.sqrt(edge_similarity_value * verb_similarity)
+                #punishment
+            # if the verb is the same, we increase the edge similarity value
+            if verb_similarity >= 1.0:
+                edge_score = math.sqrt(edge_similarity_value * verb_similarity)
+            if edge_score >= 1.0:
+                edge_score = 1.0
+        return edge_score
+
+    @classmethod
+    def _combination_search(cls, campaign: Campaign, procedure: Procedure, k_list: list, v_list: list, node_matrix: dict, campaign_index: CampaignIndex):
+        """ depth-first search over the candidate combinations, in the same order as itertools.product(*v_list)
+            a branch is pruned when an upper bound of its scores is below the running max,
+            or not above MATCHING_THRESHOLD once a combination is recorded.
+            once the combinations below a branch fit in ALIGNMENT_BATCH_SIZE, they are scored together
+            from the node and edge scores of each candidate, only the recorded combinations are turned into mappers
+            return max_value, max_combination, all_result
+        """
+        # upper_bound takes the distance of every edge to be at least 1, ACTOR edges use min(ACTOR_TOLERATE_DISTANCE, distance)
+        assert Keys.ACTOR_TOLERATE_DISTANCE >= 1, "the bounds of the combination search need Keys.ACTOR_TOLERATE_DISTANCE >= 1"
+        all_result = []
+        max_value = 0.0
+        max_combination = None
+        n = len(k_list)
+        position = {k: i for i, k in enumerate(k_list)}
+        # ACTOR-only and OTHER-only nodes are not counted in the node similarity
+        counted = []
+        for k in k_list:
+            labels = procedure.graph_nodes[k]["meta"]["label"]
+            counted.append(not (len(labels) == 1 and labels[0] in ["ACTOR", "OTHER"]))
+        # similarity[i][a]: similarity of the candidate a of node i, -1 (no similar node) counts as 0
+        similarity = [[0.0 if c == -1 else c[1] for c in v] for v in v_list]
+        node_values = [[s if counted[i] else 0.0 for s in similarity[i]] for i in range(n)]
+        node_scores = [np.array(values, dtype=np.float64) for values in node_values]
+        similarity_scores = [np.array(values, dtype=np.float64) for values in similarity]
+        best = [max(s) for s in similarity]
+        normalize_factor = len(procedure.graph_nodes) - sum(1 for i in range(n) if not counted[i] and v_list[i][0] != -1)
+        if normalize_factor == 0:
+            normalize_factor = 1
+        node_suffix = [0.0] * (n + 1)
+        for i in range(n - 1, -1, -1):
+            node_suffix[i] = node_suffix[i + 1] + (best[i] if counted[i] else 0.0)
+        edges = [(k, e, position[e["source"]], position[e["dest"]]) for k, e in procedure.graph_edges.items()
+                 if e["source"] in procedure.graph_nodes and e["dest"] in procedure.graph_nodes]
+        # edge_scores[j][a][b]: score of edge j for the candidates a and b of its source and dest, NaN until needed,
+        # this is the memo of Alignment._edge_score keyed by (edge id, campaign source, campaign dest)
+        edge_scores = [np.full((len(v_list[ps]), len(v_list[pd])), np.nan) for k, e, ps, pd in edges]
+        # verb_similarities[j][b]: the part of the score of edge j that only depends on the candidate b of its dest
+        verb_similarities = [dict() for _ in edges]
+        edge_verbs = [Alignment._edge_verbs(procedure, e) for k, e, ps, pd in edges]
+        ready = [[] for _ in range(n)] # edges whose both ends are chosen at depth i
+        for j, (k, e, ps, pd) in enumerate(edges):
+            ready[max(ps, pd)].append(j)
+        remaining = [1] * (n + 1) # number of combinations below depth i
+        for i in range(n - 1, -1, -1):
+            remaining[i] = remaining[i + 1] * len(v_list[i])
+        choice = [None] * n # index of the candidate chosen for each node
+        stats = {"procedures": 1, "combinations": remaining[0], "explored": 0, "pruned": 0, "truncated": 0, "edge_hits": 0, "edge_misses": 0}
+        EPS = 1e-9
+
+        def fill(j, sources, dests, lookups):
+            # score the candidate pairs (sources[i], dests[i]) of edge j that are not known yet,
+            # lookups is the number of combinations reading these pairs
+            k, e, ps, pd = edges[j]
+            missing = np.isnan(edge_scores[j][sources, dests])
+            stats["edge_misses"] += int(missing.sum())
+            stats["edge_hits"] += lookups - int(missing.sum())
+            for a, b in zip(sources[missing], dests[missing]):
+                source, dest = v_list[ps][a], v_list[pd][b]
+                if source == -1 or dest == -1:
+                    # None meaning that this procedure node does not have a similar node in campaign
+                    edge_scores[j][a, b] = 0.0
+                    continue
+                if b not in verb_similarities[j]:
+                    verb_similarities[j][b] = Alignment._edge_verb_similarity(campaign_index, procedure, edge_verbs[j], dest[0])
+                edge_scores[j][a, b] = Alignment._edge_score(campaign_index, procedure, e, source[0], dest[0], node_matrix, verb_similarities[j][b])
+
+        def combine(node_sum, edge_values):
+            # same additions in the same order as _sub_graph_alligment_score and upper_bound, so the values are identical
+            node_similarity = node_sum / normalize_factor
+            if len(edges) == 0:
+                return node_similarity / 2
+            edge_sum = 0.0
+            for value in edge_values:
+                edge_sum = edge_sum + value
+            return (node_similarity + edge_sum / len(edges)) / 2
+
+        def upper_bound(depth, node_sum):
+            # an unchosen node is at most its best candidate,
+            # an unscored edge is at most sqrt(sqrt(source * dest)) since the distance is at least 1
+            bound_values = []
+            for j, (k, e, ps, pd) in enumerate(edges):
+                if ps < depth and pd < depth:
+                    bound_values.append(edge_scores[j][choice[ps], choice[pd]])
+                    continue
+                source = best[ps] if ps >= depth else similarity[ps][choice[ps]]
+                dest = best[pd] if pd >= depth else similarity[pd][choice[pd]]
+                bound_values.append(min(1.0, math.sqrt(math.sqrt(source * dest))))
+            return combine(node_sum + node_suffix[depth], bound_values)
+
+        def mapper_of(index, b):
+            # mapper will map a node_id in procedure to a (similar)node_id in campaign
+            _mapper = dict()
+            for i in range(n):
+                c = v_list[i][index[i] if np.ndim(index[i]) == 0 else index[i][b]]
+                _mapper[k_list[i]] = None if c == -1 else c
+            return _mapper
+
+        def record(_sub_graph_similarity, _mapper):
+            nonlocal max_value, max_combination
+            # save the best subgraph
+            max_value = _sub_graph_similarity
+            max_combination = _mapper
+            if _sub_graph_similarity > Keys.MATCHING_THRESHOLD:
+                temp_mapper = {k:v for k,v in _mapper.items() if not (len(procedure.graph_nodes[k]["meta"]["label"])==1 and "ACTOR" in procedure.graph_nodes[k]["meta"]["label"])}
+                all_result.append((_sub_graph_similarity,temp_mapper, _mapper))
+
+        def score_leaf():
+            stats["explored"] += 1
+            _mapper = mapper_of(choice, 0)
+            edge_alignment = {edges[j][0]: float(edge_scores[j][choice[ps], choice[pd]]) for j, (k, e, ps, pd) in enumerate(edges)}
+            _sub_graph_similarity = Alignment._sub_graph_alligment_score(_mapper, edge_alignment, procedure)
+            if _sub_graph_similarity >= 1.0:
+                _sub_graph_similarity = 1.0
+            if _sub_graph_similarity >= max_value:
+                record(_sub_graph_similarity, _mapper)
+
+        def score_block(depth, node_sum):
+            # every combination below depth at once, the branches the search would prune or not reach are masked
+            size = remaining[depth]
+            # candidate indexes of every node for the combinations below depth, in itertools.product order
+            index = list(choice[:depth])
+            if depth < n:
+                index.extend(np.unravel_index(np.arange(size), [len(v) for v in v_list[depth:]]))
+            node_sums = [node_sum] # node_sums[t - depth]: similarity of the nodes chosen above depth t
+            for i in range(depth, n):
+                node_sums.append(node_sums[-1] + node_scores[i][index[i]])
+            offsets = np.arange(size)
+            # combinations outside the branches pruned against the max known before the block,
+            # only those need their edges scored
+            alive = np.ones(size, dtype=bool)
+            branches = [] # upper bound of the branch at depth t containing each combination, and where that branch starts
+            for t in range(depth + 1, n + 1):
+                for j in ready[t - 1]:
+                    k, e, ps, pd = edges[j]
+                    pairs = np.unique(np.broadcast_to(index[ps] * len(v_list[pd]) + index[pd], (size,))[alive])
+                    fill(j, pairs // len(v_list[pd]), pairs % len(v_list[pd]), int(alive.sum()))
+                bound_values = []
+                for j, (k, e, ps, pd) in enumerate(edges):
+                    if ps < t and pd < t:
+                        bound_values.append(edge_scores[j][index[ps], index[pd]])
+                        continue
+                    source = best[ps] if ps >= t else similarity_scores[ps][index[ps]]
+                    dest = best[pd] if pd >= t else similarity_scores[pd][index[pd]]
+                    bound_values.append(np.minimum(1.0, np.sqrt(np.sqrt(source * dest))))
+                bound = np.broadcast_to(combine(node_sums[t - depth] + node_suffix[t], bound_values), (size,))
+                start = offsets - offsets % remaining[t]
+                # a branch not above MATCHING_THRESHOLD is pruned once a combination is recorded,
+                # the first reached combination of the block is always recorded when none was before
+                alive &= ~((bound + EPS <= Keys.MATCHING_THRESHOLD) & ((max_combination is not None) | (start > 0)))
+                alive &= ~(bound + EPS < max_value)
+                branches.append((bound, start))
+            edge_values = [edge_scores[j][index[ps], index[pd]] for j, (k, e, ps, pd) in enumerate(edges)]
+            scores = np.minimum(np.broadcast_to(combine(node_sums[-1], edge_values), (size,)), 1.0)
+            # a branch below the running max is pruned, the combinations it holds can not raise that max
+            pruned = ~alive
+            reached = np.maximum.accumulate(np.maximum(np.where(pruned, -np.inf, scores), max_value))
+            before = np.concatenate(([max_value], reached))
+            for bound, start in branches:
+                pruned |= bound + EPS < before[start]
+            explored = ~pruned
+            end = size
+            beyond = explored & (np.cumsum(explored) > Keys.ALIGNMENT_MAX_COMBINATIONS - stats["explored"])
+            if beyond.any():
+                stats["truncated"] = 1
+                end = int(np.argmax(beyond))
+            explored = explored[:end]
+            scores = scores[:end]
+            stats["explored"] += int(explored.sum())
+            stats["pruned"] += int(end - explored.sum())
+            # a combination is recorded when it is not below the running max
+            running = np.maximum.accumulate(np.maximum(np.where(explored, scores, -np.inf), max_value))
+            recorded = np.nonzero(explored & (scores >= running))[0]
+            if len(recorded) == 0:
+                return
+            last = recorded[-1]
+            for b in recorded[scores[recorded] > Keys.MATCHING_THRESHOLD]:
+                if b != last:
+                    record(float(scores[b]), mapper_of(index, b))
+            record(float(scores[last]), mapper_of(index, last))
+
+        def visit(depth, node_sum):
+            if stats["explored"] >= Keys.ALIGNMENT_MAX_COMBINATIONS:
+                stats["truncated"] = 1
+                return
+            if Keys.ALIGNMENT_BATCH_SIZE > 0 and remaining[depth] <= Keys.ALIGNMENT_BATCH_SIZE:
+                score_block(depth, node_sum)
+                return
+            if depth == n:
+                score_leaf()
+                return
+            for a in range(len(v_list[depth])):
+                if stats["truncated"]:
+                    break
+                choice[depth] = a
+                for j in ready[depth]:
+                    k, e, ps, pd = edges[j]
+                    fill(j, np.array([choice[ps]]), np.array([choice[pd]]), 1)
+                _node_sum = node_sum + node_values[depth][a]
+                bound = upper_bound(depth + 1, _node_sum)
+                if bound + EPS < max_value or (max_combination is not None and bound + EPS <= Keys.MATCHING_THRESHOLD):
+                    stats["pruned"] += remaining[depth + 1]
+                else:
+                    visit(depth + 1, _node_sum)
+            choice[depth] = None
+
+        visit(0, 0.0)
+        record_search_stats(stats)
+        return max_value, max_combination, all_result
+
+    @classmethod
     def node_alignment(cls, campaign: Campaign, sub_graph: list, procedure: Procedure, procedure_similarity= False):
         """ for each node in procedure, calculate the similarity between it and all nodes in campaign
             if sim_value > threshold, save these similar nodes into a dictionary
             dict[node_in_procedure] = [(node_in_campaign, sim_value), ...]
         """
+        node_index = CampaignIndex.get(campaign).nodes
+        if not hasattr(procedure, "node_index"):
+            procedure.node_index = NodeIndex(procedure)
+        positions = node_index.positions(sub_graph)
         _node_similarity_score = dict()
         _node_similarity_matrix = dict()
-        for k,v in procedure.graph_nodes.items():
-            node2 = v["meta"] # node2 is from procedure
-
-            if k not in _node_similarity_score:
-                    _node_similarity_score[k] = list()
-            if k not in _node_similarity_matrix:
-                    _node_similarity_matrix[k] = dict()
-            for node_id in sub_graph:
-                node1 = campaign.graph_nodes[node_id]["meta"] # node1 is from campaign
-                sim_value = Alignment._node_similarity_calculation(node1, node2, campaign, procedure, procedure_similarity)    
-                if sim_value > 1.0:
-                    sim_value = 1.0
-                if sim_value > Keys.NODE_SIMILARITY_THRESHOLD:
-                    _node_similarity_score[k].append((node_id, sim_value))
-                    _node_similarity_matrix[k][node_id] = sim_value
-            # if len(_node_similarity_score[k])== 0:
-            #     if node2["text"] in malwares:
-            #         node2["label"]= ["ACTOR"] # try to treat malware as attacker
-            #         for node_id in sub_graph:
-            #             node1 = campaign.graph_nodes[node_id]["meta"] # node1 is from campaign
-            #             sim_value = Alignment._node_similarity_calculation(node1, node2, campaign, procedure, procedure_similarity)    
-            #             if sim_value > Keys.NODE_SIMILARITY_THRESHOLD:
-            #                 _node_similarity_score[k].append((node_id, sim_value))
-            #                 _node_similarity_matrix[k][node_id] = sim_value
+        for k in procedure.graph_nodes.keys():
+            sim_values = Alignment._node_similarity_row(node_index, positions, procedure.node_index, procedure.node_index.position[k], procedure_similarity)
+            sim_values = np.minimum(sim_values, 1.0)
+            similar = np.nonzero(sim_values > Keys.NODE_SIMILARITY_THRESHOLD)[0]
+            _node_similarity_score[k] = [(sub_graph[i], sim_value) for i, sim_value in zip(similar.tolist(), sim_values[similar].tolist())]
+            _node_similarity_matrix[k] = dict(_node_similarity_score[k])
             if len(_node_similarity_score[k])== 0:
                     _node_similarity_score[k]= [-1]
         
         return _node_similarity_score, _node_similarity_matrix
-    
 
+    @classmethod
+    def _node_similarity_row(cls, campaign_index: NodeIndex, positions: np.ndarray, procedure_index: NodeIndex, j: int, procedure_similarity= False):
+        """ _node_similarity_calculation between the node j of procedure_index and the campaign nodes at positions,
+            computed with label masks over all of them at once
+        """
+        masks = campaign_index.masks[positions]
+        intersect = masks & procedure_index.masks[j]
+        matched = intersect != 0
+        label_similarity = np.where(matched & (intersect != label_bit("OTHER")), Keys.LAMDA, Keys.SOFT_LAMDA)
+        # single ACTOR (except "it"/"they"), VULNERABILITY and USER nodes only match the nodes sharing a label
+        actor = campaign_index.is_single("ACTOR")[positions] & ~campaign_index.pronoun[positions]
+        actor2 = procedure_index.is_single("ACTOR")[j] and not procedure_index.pronoun[j]
+        gated = campaign_index.gated[positions]
+        gated2 = procedure_similarity or procedure_index.gated[j]
+        gated = ~matched & (gated | gated2)
+        function = label_bit("FUNCTION")
+        malware = np.zeros(len(positions), dtype=bool)
+        if procedure_similarity and procedure_index.masks[j] & function and procedure_index.malware[j]:
+            malware = (masks & function != 0) & campaign_index.malware[positions] & ~gated
+        max_similarity = np.zeros(len(positions), dtype=np.float64)
+        used = np.nonzero(~gated & ~malware)[0]
+        if Keys.BERT_SIM_ENABLE:
+            campaign_indices = campaign_index.phrase_indices(bert_similarity)
+            procedure_indices = procedure_index.phrase_indices(bert_similarity)
+            max_similarity[used] = bert_similarity.max_similarity_bulk(procedure_indices[j], [campaign_indices[p] for p in positions[used]])
+        else:
+            max_similarity[used] = [Alignment.get_stringSet_similarity(campaign_index.texts[p], procedure_index.texts[j]) for p in positions[used]]
+        return_value = label_similarity+ (1- label_similarity)* max_similarity # weighted average
+        sim_values = return_value.copy()
+        low = return_value <= 0.8
+        # scale up the similarity of two USER/VULNERABILITY/REGISTRY nodes
+        boosted = np.zeros(len(positions), dtype=bool)
+        for label in ["USER", "VULNERABILITY", "REGISTRY"]:
+            if procedure_index.is_single(label)[j]:
+                boosted |= campaign_index.is_single(label)[positions]
+        boosted &= low & (return_value < 0.8) & (return_value > 0.5)
+        sim_values[boosted] = return_value[boosted] + Keys.NODE_SIMILARITY_BOOST
+        # implicit actor in action should be tolerated
+        if actor2:
+            sim_values[low & actor] = 0.95
+        sim_values[malware] = 1.0
+        sim_values[gated] = 0.0
+        return sim_values
 
     @classmethod
     def _node_similarity_calculation(cls, node1: dict, node2: dict, campaign: Campaign, procedure: Procedure, procedure_similarity= False):
@@ -618,16 +1103,76 @@ class Alignment():
                 return 0.95 #scale up actor similarity, implicit actor in action should be tolerated
         if ("USER" in node1["label"] and len(node1["label"])==1 ) and ("USER" in node2["label"] and len(node2["label"])==1):
             if return_value < 0.8 and return_value > 0.5:
-                return return_value + 0.2
+                return return_value + Keys.NODE_SIMILARITY_BOOST
         if ("VULNERABILITY" in node1["label"] and len(node1["label"])==1 ) and ("VULNERABILITY" in node2["label"] and len(node2["label"])==1):
             if return_value < 0.8 and return_value > 0.5:
-                return return_value + 0.2
+                return return_value + Keys.NODE_SIMILARITY_BOOST
         if ("REGISTRY" in node1["label"] and len(node1["label"])==1 ) and ("REGISTRY" in node2["label"] and len(node2["label"])==1):
             if return_value < 0.8 and return_value > 0.5:
-                return return_value + 0.2
+                return return_value + Keys.NODE_SIMILARITY_BOOST
         return return_value
     
     
+    @classmethod
+    def _node_label_kind(cls, node: dict):
+        """ the part of a node that _node_similarity_calculation looks at before the text:
+            (label set, the node blocks every non-intersecting label set, single label that can get a boost)
+        """
+        labels = node["label"]
+        single = labels[0] if len(labels) == 1 else None
+        gated = single in ["VULNERABILITY", "USER"] or (single == "ACTOR" and node["text"].lower() not in ["it","they"])
+        boosted = single if single in ["USER", "VULNERABILITY", "REGISTRY"] else None
+        return (frozenset(labels), gated, boosted)
+
+    @classmethod
+    def _kind_text_usage(cls, kind1: tuple, kind2: tuple):
+        """ 0: _node_similarity_calculation returns 0.0 without the text similarity
+            1: the text similarity is used, only the values above the strict floor matter
+            2: the text similarity is used and the pair can get NODE_SIMILARITY_BOOST
+        """
+        labels1, gated1, boosted1 = kind1
+        labels2, gated2, boosted2 = kind2
+        if len(labels1.intersection(labels2)) == 0 and (gated1 or gated2):
+            return 0
+        if boosted1 is not None and boosted1 == boosted2:
+            return 2
+        return 1
+
+    @classmethod
+    def similarity_blocks(cls, procedures: list, campaigns: list):
+        """ partition procedure phrases x campaign phrases by node labels,
+            return [(procedure phrases, campaign phrases, floor), ...] covering every pair alignment can consult,
+            the pairs left out are always gated to 0.0 by _node_similarity_calculation
+        """
+        procedure_kinds = dict()
+        for procedure in procedures:
+            for phrase, nodes in procedure.get_phrase_nodes().items():
+                procedure_kinds.setdefault(phrase, set()).update(cls._node_label_kind(node) for node in nodes)
+        campaign_kinds = dict()
+        for campaign in campaigns:
+            for phrase, nodes in campaign.get_phrase_nodes().items():
+                campaign_kinds.setdefault(phrase, set()).update(cls._node_label_kind(node) for node in nodes)
+        kinds = list(set(kind for _kinds in campaign_kinds.values() for kind in _kinds))
+        # procedure phrases with the same usage over all campaign kinds share the same block columns
+        classes = dict()
+        for phrase, _kinds in procedure_kinds.items():
+            usage = tuple(max(cls._kind_text_usage(kind1, kind2) for kind1 in _kinds) for kind2 in kinds)
+            classes.setdefault(usage, []).append(phrase)
+        kind_ids = {kind: i for i, kind in enumerate(kinds)}
+        campaign_phrase_kinds = {phrase: [kind_ids[kind] for kind in _kinds] for phrase, _kinds in campaign_kinds.items()}
+        floors = {1: similarity_floor(boosted = False), 2: similarity_floor(boosted = True)}
+        blocks = list()
+        for usage, phrases in classes.items():
+            columns = {1: [], 2: []}
+            for phrase, ids in campaign_phrase_kinds.items():
+                level = max(usage[i] for i in ids)
+                if level > 0:
+                    columns[level].append(phrase)
+            for level, _columns in columns.items():
+                if len(_columns) > 0:
+                    blocks.append((phrases, _columns, floors[level]))
+        return blocks
+
     @classmethod
     def _accumulate_node_similarity(cls, nodes_mapper, procedure: Procedure):
         similarity = 0.0
@@ -731,7 +1276,7 @@ class Alignment():
             # intersect_ = list(set(good_features).intersection(set(labels)))
             # if len(intersect_) > 0:
             good_nodes.append(id2order[_id]) # save all the node_id
-            sent_indexes.append(campaign.graph_nodes[_id]["meta"]["sent_index"]) # save all the sent_index
+            sent_indexes.append(CampaignIndex.get(campaign).sent_indexes[_id]) # save all the sent_index
             combine_ids.append(_id)
             _data = dict()
             _data["source"] = procedure.graph_nodes[k]["meta"]
@@ -811,15 +1356,17 @@ class Alignment():
 
 
     @classmethod
-    def all_alignment_multiprocess(cls, campaign:Campaign, procedures: dict, techniques: dict):
+    def all_alignment_multiprocess(cls, campaign:Campaign, procedures: dict, techniques: dict, executor: ProcessPoolExecutor = None):
+        """ executor: an alignment_pool started with the campaign_chunks of campaign, a pool is started for this campaign when None
+        """
         #preparing the bert similarity
         if Keys.MULTI_PROCESSING:
             if not hasattr(campaign, "bert_path"):
-                bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH, f"{campaign.id}.pkl")
+                bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH, f"{campaign.id}.npy")
             else:
                 bert_sim_path = campaign.bert_path
         else:
-            bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH,"all.pkl")
+            bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH,"all.npy")
         # if os.path.exists(bert_sim_path):         
         #     try:
         #         print("loading bert similarity")
@@ -832,39 +1379,50 @@ class Alignment():
         #         bert_similarity.compute_range(procedures_phrases,campaign_phrases )
         #         bert_similarity.to_pickle(bert_sim_path)
         
+        campaign.search_stats = dict()
         final_result = dict()
         futures = []
-        keys = list(procedures.keys())
-        with concurrent.futures.ProcessPoolExecutor(max_workers=NUM_PROCESS) as executor:
-            max_numer_of_procedures = len(procedures)
-            for i in range(0, max_numer_of_procedures, NUM_PROCEDURES_PER_PROCESS):
-                start = i
-                end = i+NUM_PROCEDURES_PER_PROCESS if i+NUM_PROCEDURES_PER_PROCESS < max_numer_of_procedures else max_numer_of_procedures
-                procedure_id_slice = keys[start:end]
-                procedure_slice = [procedures[k] for k in procedure_id_slice]
-
-                futures.append(executor.submit(alignment_with_range, campaign, procedure_slice, techniques, bert_sim_path))
+        keys = procedure_keys(procedures)
+        own_pool = executor is None
+        if own_pool:
+            executor = alignment_pool(procedures, techniques, campaign_chunks([campaign]))
+        try:
+            start = time.time()
+            worker_busy = dict()
+            for task in procedure_tasks([campaign], procedures, keys):
+                # only the procedure ids and the chunk key travel, the workers got the procedures and chunks when the pool started
+                futures.append(executor.submit(alignment_with_ids, (campaign.id, 0), task, bert_sim_path))
             #wait for all processes to finish
             for result in as_completed(futures):
-                rs = result.result()
+                rs, stats, (pid, busy) = result.result()
+                worker_busy[pid] = worker_busy.get(pid, 0.0) + busy
+                merge_search_stats(campaign.search_stats, stats)
                 if rs is None:
                     continue
                 for k,v in rs.items():
                     if k not in final_result:
                         final_result[k] = list()
                     final_result[k].extend(v)         
+        finally:
+            if own_pool:
+                executor.shutdown()
         campaign.mapper = final_result
+        campaign.worker_busy = worker_busy
+        print_search_stats(campaign.search_stats)
+        print_worker_stats(worker_busy, time.time() - start)
 
     @classmethod
-    def all_alignment_big_campaign_multiprocess(cls, bigcampaign:BigCampaign, procedures: dict, techniques: dict):
+    def all_alignment_big_campaign_multiprocess(cls, bigcampaign:BigCampaign, procedures: dict, techniques: dict, executor: ProcessPoolExecutor = None):
+        """ executor: an alignment_pool started with the campaign_chunks of bigcampaign, a pool is started for this report when None
+        """
         #preparing the bert similarity
         if Keys.MULTI_PROCESSING:
             if not hasattr(bigcampaign, "bert_path"):
-                bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH, f"{bigcampaign.id}.pkl")
+                bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH, f"{bigcampaign.id}.npy")
             else:
                 bert_sim_path = bigcampaign.bert_path
         else:
-            bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH,"all.pkl")
+            bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH,"all.npy")
         # if os.path.exists(bert_sim_path):         
         #     try:
         #         print("loading bert similarity")
@@ -876,44 +1434,104 @@ class Alignment():
         #         campaign_phrases = campaign.phrases
         #         bert_similarity.compute_range(procedures_phrases,campaign_phrases )
         #         bert_similarity.to_pickle(bert_sim_path)
-        for campaign in bigcampaign.data:
-            final_result = dict()
-            futures = []
-            keys = list(procedures.keys())
-            with concurrent.futures.ProcessPoolExecutor(max_workers=NUM_PROCESS) as executor:
-                max_numer_of_procedures = len(procedures)
-                for i in range(0, max_numer_of_procedures, NUM_PROCEDURES_PER_PROCESS):
-                    start = i
-                    end = i+NUM_PROCEDURES_PER_PROCESS if i+NUM_PROCEDURES_PER_PROCESS < max_numer_of_procedures else max_numer_of_procedures
-                    procedure_id_slice = keys[start:end]
-                    procedure_slice = [procedures[k] for k in procedure_id_slice]
+        bigcampaign.search_stats = dict()
+        bigcampaign.skipped_per_chunk = []
+        keys = procedure_keys(procedures)
+        own_pool = executor is None
+        if own_pool:
+            executor = alignment_pool(procedures, techniques, campaign_chunks([bigcampaign]))
+        try:
+            # the tasks of every chunk are queued at once, so that no worker waits for the last task of a chunk
+            start = time.time()
+            worker_busy = dict()
+            futures = dict()
+            for index, campaign in enumerate(bigcampaign.data):
+                for task in procedure_tasks([campaign], procedures, keys):
+                    futures[executor.submit(alignment_with_ids, (bigcampaign.id, index), task, bert_sim_path)] = index
+            final_results = [dict() for _ in bigcampaign.data]
+            chunk_stats = [dict() for _ in bigcampaign.data]
+            #wait for all processes to finish
+            for result in as_completed(futures):
+                index = futures[result]
+                rs, stats, (pid, busy) = result.result()
+                worker_busy[pid] = worker_busy.get(pid, 0.0) + busy
+                merge_search_stats(chunk_stats[index], stats)
+                if rs is None:
+                    continue
+                for k,v in rs.items():
+                    if k not in final_results[index]:
+                        final_results[index][k] = list()
+                    final_results[index][k].extend(v)
+        finally:
+            if own_pool:
+                executor.shutdown()
+        for index, campaign in enumerate(bigcampaign.data):
+            campaign.mapper = final_results[index]
+            campaign.search_stats = chunk_stats[index]
+            merge_search_stats(bigcampaign.search_stats, campaign.search_stats)
+            bigcampaign.skipped_per_chunk.append(campaign.search_stats.get("skipped", 0))
+        bigcampaign.worker_busy = worker_busy
+        print_search_stats(bigcampaign.search_stats)
+        print_worker_stats(worker_busy, time.time() - start)
+        bigcampaign.mapper_gathering()
 
-                    futures.append(executor.submit(alignment_with_range, campaign, procedure_slice, techniques, bert_sim_path))
-                #wait for all processes to finish
-                for result in as_completed(futures):
-                    rs = result.result()
-                    if rs is None:
-                        continue
+    @classmethod
+    def all_alignment_cross_report_multiprocess(cls, bigcampaigns: List[BigCampaign], procedures: dict, techniques: dict, bert_sim_path:str = None):
+        """ align the campaign chunks of every report in one procedure-major pass over the procedures
+            the chunks reach the workers once with the pool, the results are scattered back to each campaign.mapper
+            the similarity store (all.npy by default) must cover the phrases of every report
+        """
+        if bert_sim_path is None:
+            bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH,"all.npy")
+        chunks = campaign_chunks(bigcampaigns)
+        chunk_keys = list(chunks.keys())
+        targets = list(chunks.values())
+        keys = procedure_keys(procedures)
+        start = time.time()
+        worker_busy = dict()
+        final_results = [dict() for _ in targets]
+        chunk_stats = [dict() for _ in targets]
+        with alignment_pool(procedures, techniques, chunks) as executor:
+            futures = [executor.submit(alignment_with_target_ids, chunk_keys, task, bert_sim_path) for task in procedure_tasks(targets, procedures, keys)]
+            #wait for all processes to finish
+            for result in as_completed(futures):
+                results, stats, (pid, busy) = result.result()
+                worker_busy[pid] = worker_busy.get(pid, 0.0) + busy
+                for index, rs in enumerate(results):
+                    merge_search_stats(chunk_stats[index], stats[index])
                     for k,v in rs.items():
-                        if k not in final_result:
-                            final_result[k] = list()
-                        final_result[k].extend(v)
-            end = time.time()            
-            campaign.mapper = final_result
-        bigcampaign.mapper_gathering()
+                        if k not in final_results[index]:
+                            final_results[index][k] = list()
+                        final_results[index][k].extend(v)
+        index = 0
+        for bigcampaign in bigcampaigns:
+            bigcampaign.search_stats = dict()
+            bigcampaign.skipped_per_chunk = []
+            for campaign in bigcampaign.data:
+                campaign.mapper = final_results[index]
+                campaign.search_stats = chunk_stats[index]
+                merge_search_stats(bigcampaign.search_stats, campaign.search_stats)
+                bigcampaign.skipped_per_chunk.append(campaign.search_stats.get("skipped", 0))
+                index += 1
+            bigcampaign.worker_busy = worker_busy
+            print(f"report {bigcampaign.id}:")
+            print_search_stats(bigcampaign.search_stats)
+            bigcampaign.mapper_gathering()
+        print_worker_stats(worker_busy, time.time() - start)
     # single process version for debugging
     @classmethod
     def all_alignment_sequential(cls, campaign:Campaign, procedures: dict, techniques: dict):
         #preparing the bert similarity
-        bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH, f"{campaign.id}.pkl")
+        bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH, f"{campaign.id}.npy")
         assert os.path.exists(bert_sim_path), "Bert similarity file does not exist"
         global bert_similarity
-        bert_similarity = CosineSimilarity.from_pickle(bert_sim_path)
+        bert_similarity = CosineSimilarity.from_file(bert_sim_path)
 
         
+        campaign.search_stats = dict()
         final_result = dict()
         futures = []
-        keys = list(procedures.keys())
+        keys = procedure_keys(procedures)
         max_numer_of_procedures = len(procedures)
         for i in range(0, max_numer_of_procedures, NUM_PROCEDURES_PER_PROCESS):
                 start = i
@@ -921,7 +1539,8 @@ class Alignment():
                 procedure_id_slice = keys[start:end]
                 procedure_slice = [procedures[k] for k in procedure_id_slice]
 
-                rs = alignment_with_range(campaign, procedure_slice, techniques, bert_sim_path)
+                rs, stats = alignment_with_range(campaign, procedure_slice, techniques, bert_sim_path)
+                merge_search_stats(campaign.search_stats, stats)
                 if rs is None:
                     continue
                 for k,v in rs.items():
@@ -930,22 +1549,26 @@ class Alignment():
                     final_result[k].extend(v)
         end = time.time()            
         campaign.mapper = final_result
+        print_search_stats(campaign.search_stats)
     
     @classmethod
-    def all_alignment_sequential_big_campaign_sequential(cls, bigcampaign:BigCampaign, procedures: dict, techniques: dict):
+    def all_alignment_sequential_big_campaign_sequential(cls, bigcampaign:BigCampaign, procedures: dict, techniques: dict, bert_sim_path:str = None):
         #preparing the bert similarity
-
-        bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH,"all.pkl")
+        if bert_sim_path is None:
+            bert_sim_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH,"all.npy")
         assert os.path.exists(bert_sim_path), "Bert similarity file does not exist"
 
         print("loading bert similarity")
         global bert_similarity
-        bert_similarity = CosineSimilarity.from_pickle(bert_sim_path)
+        bert_similarity = CosineSimilarity.from_file(bert_sim_path)
 
         
+        bigcampaign.search_stats = dict()
+        bigcampaign.skipped_per_chunk = []
         for campaign in bigcampaign.data:
+            campaign.search_stats = dict()
             final_result = dict()
-            keys = list(procedures.keys())
+            keys = procedure_keys(procedures)
             max_numer_of_procedures = len(procedures)
             for i in range(0, max_numer_of_procedures, NUM_PROCEDURES_PER_PROCESS):
                 start = i
@@ -953,7 +1576,8 @@ class Alignment():
                 procedure_id_slice = keys[start:end]
                 procedure_slice = [procedures[k] for k in procedure_id_slice]
 
-                rs = alignment_with_range(campaign, procedure_slice, techniques, bert_sim_path)
+                rs, stats = alignment_with_range(campaign, procedure_slice, techniques, bert_sim_path)
+                merge_search_stats(campaign.search_stats, stats)
                 if rs is None:
                     continue
                 for k,v in rs.items():
@@ -961,7 +1585,10 @@ class Alignment():
                         final_result[k] = list()
                     final_result[k].extend(v)          
             campaign.mapper = final_result
+            merge_search_stats(bigcampaign.search_stats, campaign.search_stats)
+            bigcampaign.skipped_per_chunk.append(campaign.search_stats.get("skipped", 0))
             
+        print_search_stats(bigcampaign.search_stats)
         bigcampaign.mapper_gathering()
 
     
@@ -1007,13 +1634,7 @@ class Alignment():
         start = 0
         for campaign in bigcampaign.data:
             tech_alginment_rs = dict()
-            if not hasattr(campaign, "nodeID_2_order") :
-                campaign.nodeID_2_order = {}
-                node_ids = list(campaign.graph_nodes.keys())
-                node_ids = sorted(node_ids)
-                for i in range(len(node_ids)):
-                    campaign.nodeID_2_order[node_ids[i]] = i
-            rs = cls.campaign_technique_alignment(campaign, techniques, campaign.nodeID_2_order)
+            rs = cls.campaign_technique_alignment(campaign, techniques, CampaignIndex.get(campaign).order)
             for k,v in rs.items():
                 if k not in tech_alginment_rs:
                     tech_alginment_rs[k] = list()
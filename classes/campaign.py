@@ -1,4 +1,5 @@
 from classes.paragraph import Paragraph
+from classes.campaign_index import CampaignIndex
 import json
 from modules import *
 from keys import *
@@ -14,6 +15,7 @@ class Campaign(Paragraph):
             if image_path != "":
                 super().rescontruct_graph() # this step will change the graph to relfect current graph nodes and edges
                 self.draw(image_path)
+            self.campaign_index = CampaignIndex(self)
             self.mapper = dict()
             self.id = id
         
@@ -35,6 +37,7 @@ class Campaign(Paragraph):
         self.id = data["id"]
         super().from_dict(data)
         super().get_phrases()
+        self.campaign_index = CampaignIndex(self)
     def from_json(self, path: str):
         with open(path, "r") as f:
             data = json.load(f)
@@ -42,6 +45,7 @@ class Campaign(Paragraph):
             self.id = data["id"]
             super().from_dict(data)
             super().get_phrases()
+            self.campaign_index = CampaignIndex(self)
     
     def to_pickle(self, path: str):
         with open(path, "wb") as f:
@@ -0,0 +1,60 @@
+import numpy as np
+from modules import verbs_mask
+from classes.distance_index import DistanceIndex
+from classes.node_index import NodeIndex
+
+
+class CampaignIndex():
+    """ per-campaign lookup structures of the alignment, built once per campaign chunk and pickled with it to the workers
+        nodes: NodeIndex, label masks, true texts and their phrase indices
+        distances: DistanceIndex, hop and sentence distances between every pair of nodes,
+                   O(n^2) so it is built on first use by the alignment and not pickled with the campaign
+        order: node id -> order id (rank of the node id), the ids used by the alignment records
+        label_nodes: label -> node ids carrying this label
+        ungated: number of nodes that can match a node of any label (see NodeIndex.gated)
+        verbs: node id -> verbs of the object nodes, the campaign side of the verb checks
+        verb_masks: node id -> verbs_mask of verbs, the verb groups of the object nodes
+        sent_indexes: node id -> sent_index
+    """
+    def __init__(self, campaign):
+        self.nodes = NodeIndex(campaign)
+        self.campaign = campaign
+        self._distances = None
+        self.order = {node_id: i for i, node_id in enumerate(sorted(campaign.graph_nodes.keys()))}
+        self.label_nodes = dict()
+        self.verbs = dict()
+        self.sent_indexes = dict()
+        for node_id, node in campaign.graph_nodes.items():
+            meta = node["meta"]
+            for label in meta["label"]:
+                self.label_nodes.setdefault(label, []).append(node_id)
+            if meta["type"] == "object" and "verbs" in meta:
+                self.verbs[node_id] = list(set(meta["verbs"]))
+            if "sent_index" in meta:
+                self.sent_indexes[node_id] = meta["sent_index"]
+        self.label_nodes = {label: np.array(node_ids, dtype=np.int64) for label, node_ids in self.label_nodes.items()}
+        self.verb_masks = {node_id: verbs_mask(verbs) for node_id, verbs in self.verbs.items()}
+        self.ungated = int(np.count_nonzero(~self.nodes.gated))
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getstate__(self):
+        # the distances are rebuilt by each process that aligns the campaign
+        state = self.__dict__.copy()
+        state["_distances"] = None
+        return state
+
+    @property
+    def distances(self):
+        if self._distances is None:
+            self._distances = DistanceIndex(self.campaign)
+        return self._distances
+
+    @classmethod
+    def get(cls, campaign):
+        """ the index of campaign, built on first use for the campaigns that do not carry one (e.g. older pickles)
+        """
+        if not hasattr(campaign, "campaign_index"):
+            campaign.campaign_index = cls(campaign)
+        return campaign.campaign_index
@@ -1,57 +1,341 @@
-from evaluate import load
 # bertscore = load("bertscore")
 from keys import Keys
 import pickle
 import json
+import hashlib
 from tqdm import tqdm
-import itertools
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+from classes.embedding_cache import EmbeddingCache
+from classes import embedding_server
 # model = gensim.models.KeyedVectors.load_word2vec_format(Keys.WORD2VEC, binary=True)
-import tensorflow_hub as hub
 import os
-os.environ["TFHUB_CACHE_DIR"] = "./data/tf_hub"
+import tempfile
+os.environ.setdefault("TFHUB_CACHE_DIR", Keys.TFHUB_CACHE_DIR)
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
-model = hub.load("https://tfhub.dev/google/universal-sentence-encoder-large/5") 
+model = None # the encoder is only loaded when new phrases have to be embedded, see get_model
+def model_path():
+    # tensorflow_hub caches a model in TFHUB_CACHE_DIR/<sha1 of the handle>
+    if Keys.USE_MODEL_DIR is not None:
+        return Keys.USE_MODEL_DIR
+    return os.path.join(os.environ["TFHUB_CACHE_DIR"], hashlib.sha1(Keys.USE_MODEL_URL.encode("utf8")).hexdigest())
+def get_model():
+    """ load the Universal Sentence Encoder from the local model directory, nothing is downloaded
+        tensorflow is imported here so the alignment workers, which only read the similarity store, never load it
+    """
+    global model
+    if model is None:
+        path = model_path()
+        if not os.path.exists(os.path.join(path, "saved_model.pb")):
+            raise FileNotFoundError(f"Universal Sentence Encoder not found in {path}, "
+                                    f"download {Keys.USE_MODEL_URL} into TFHUB_CACHE_DIR or set Keys.USE_MODEL_DIR")
+        import tensorflow_hub as hub
+        model = hub.load(path)
+    return model
+NOT_COMPUTED = np.nan # value of a phrase pair that has not been computed, alignment reads it as 0
+INT8_SCALE = 127.0 # int8 store: a cosine value v is kept as round(v * 127)
+INT8_NOT_COMPUTED = -128 # int8 store: NOT_COMPUTED
+GROWTH_MIN = 64 # rows/columns added at least when the in-memory store grows
+# rough bytes per phrase pair while a block is written: the float32 product, plus row/col ids and masks when sparse
+BLOCK_BYTES_PER_PAIR = {False: 8, True: 40}
+def vocab_path(file_name):
+    # the phrase vocabulary is saved next to the matrix: all.npy -> all.vocab.json
+    return os.path.splitext(file_name)[0] + ".vocab.json"
+def csr_paths(file_name):
+    # sparse store: values in all.npy, row pointers and column ids next to it
+    base = os.path.splitext(file_name)[0]
+    return base + ".indptr.npy", base + ".colids.npy"
+def similarity_floor(boosted = True):
+    """ the lowest phrase similarity that can still make two nodes pass Keys.NODE_SIMILARITY_THRESHOLD
+        node score = label_similarity + (1 - label_similarity) * phrase similarity, label_similarity is LAMDA or SOFT_LAMDA
+        USER/VULNERABILITY/REGISTRY pairs get + NODE_SIMILARITY_BOOST, boosted = False gives the floor without the boost
+        ACTOR pairs are scaled up to 0.95 whatever the text is, so they do not need any phrase similarity
+    """
+    lamda = max(Keys.LAMDA, Keys.SOFT_LAMDA)
+    threshold = Keys.NODE_SIMILARITY_THRESHOLD
+    if boosted:
+        threshold -= Keys.NODE_SIMILARITY_BOOST
+    return max((threshold - lamda) / (1 - lamda), 0.0)
+def normalize(embeddings):
+    # unit rows, the cosine similarity is then a plain dot product
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
 class CosineSimilarity:
+    """ similarity store between procedure phrases (rows) and campaign phrases (columns)
+        phrases are mapped to a row/column index, the values are kept in a dense matrix
+        so the store can be saved as .npy and memory-mapped by the alignment workers
+        dtype can be float32, float16 or int8 (fixed scale 1/127, the error is below 0.004)
+        with sparse = True only the values above floor are kept (CSR layout), the others read as 0
+    """
     # def __init__(self, model_name = "xlnet-large-cased"):
     #     self.f1 = {}
     #     self.model_name = model_name
-    def __init__(self):
-        self.f1 = {}
-       
+    def __init__(self, dtype = Keys.SIMILARITY_DTYPE, sparse = False, floor = None, path = None):
+        self.dtype = np.dtype(dtype)
+        self.path = path # when set, a growing dense matrix is memory-mapped next to this file instead of kept in RAM
+        self.temp_file = None # the temporary file of _resize currently holding the matrix, renamed by to_npy
+        self.rows = {} # phrase -> row index
+        self.cols = {} # phrase -> column index
+        self.sparse = sparse
+        self.floor = similarity_floor() if floor is None else floor
+        self.matrix = np.zeros((0, 0), dtype=self.dtype)
+        self.buffer = None # in-memory dense store: matrix is the (rows, cols) corner of buffer, which has room to grow
+        # CSR arrays, only used when sparse
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.colids = np.zeros(0, dtype=np.int32)
+        self.values = np.zeros(0, dtype=self.dtype)
+        self.total_pairs = 0
+        self.kept_pairs = 0
+        self.cache = None
+
+    def __getstate__(self):
+        # matrix is pickled on its own, without the spare capacity of buffer
+        state = self.__dict__.copy()
+        state["buffer"] = None
+        return state
+
     @classmethod
     def from_pickle(cls, file_name):
+        # old format: dict of dict {phrase1: {phrase2: value}}, we convert it into the matrix format
         with open(file_name, "rb") as f:
             data = pickle.load(f)
-            object = cls()
-            object.f1 = data
-            return object
+        object = cls()
+        triplets = []
+        seen = set()
+        for id1, v in data.items():
+            for id2, f1 in v.items():
+                if (id2, id1) in seen:
+                    continue # the reversed pair is already recorded
+                seen.add((id1, id2))
+                object._add_phrases([id1], [id2])
+                triplets.append((object.rows[id1], object.cols[id2], f1))
+        object._resize()
+        for r, c, f1 in triplets:
+            object.matrix[r, c] = object._encode(f1)
+        return object
+
+    @classmethod
+    def from_npy(cls, file_name, mmap_mode = "r", writable = False):
+        """ writable: the store is extended and saved again (generate_bert_object), its growth is memory-mapped next to file_name,
+            the other stores grow in RAM and never write next to file_name
+        """
+        with open(vocab_path(file_name), "r") as f:
+            vocab = json.load(f)
+        values = np.load(file_name, mmap_mode=mmap_mode)
+        object = cls(dtype = values.dtype, sparse = vocab.get("format") == "csr", floor = vocab.get("floor"), path = file_name if writable else None)
+        object.rows = {p: i for i, p in enumerate(vocab["rows"])}
+        object.cols = {p: i for i, p in enumerate(vocab["cols"])}
+        if object.sparse:
+            indptr_path, colids_path = csr_paths(file_name)
+            object.indptr = np.load(indptr_path, mmap_mode=mmap_mode)
+            object.colids = np.load(colids_path, mmap_mode=mmap_mode)
+            object.values = values
+        else:
+            object.matrix = values
+        return object
+
+    @classmethod
+    def from_file(cls, file_name, writable = False):
+        if file_name.endswith(".pkl"):
+            return cls.from_pickle(file_name)
+        return cls.from_npy(file_name, writable = writable)
+
     def to_pickle(self, file_name):
-        with open(file_name, "wb") as f:
-            pickle.dump(self.f1, f)
+        # kept for backward compatibility, the store is always written as .npy
+        self.to_npy(os.path.splitext(file_name)[0] + ".npy")
+
+    def _save_array(self, file_name, array):
+        # write to a temporary file first, the old file may still be memory-mapped
+        if self.temp_file is not None and isinstance(array, np.memmap) and array.filename is not None and os.path.abspath(array.filename) == os.path.abspath(self.temp_file):
+            array.flush() # the matrix was written in place by _resize/_write
+            os.replace(self.temp_file, file_name)
+            self.temp_file = None
+            return
+        temp_file = file_name + ".tmp"
+        with open(temp_file, "wb") as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(temp_file, file_name)
+
+    def to_npy(self, file_name):
+        vocab = dict()
+        vocab["rows"] = sorted(self.rows, key=self.rows.get)
+        vocab["cols"] = sorted(self.cols, key=self.cols.get)
+        if self.sparse:
+            vocab["format"] = "csr"
+            vocab["floor"] = self.floor
+            indptr_path, colids_path = csr_paths(file_name)
+            self._save_array(indptr_path, self.indptr)
+            self._save_array(colids_path, self.colids)
+            self._save_array(file_name, self.values)
+        else:
+            vocab["format"] = "dense"
+            self._save_array(file_name, self.matrix)
+        with open(vocab_path(file_name), "w") as f:
+            json.dump(vocab, f)
+
+    def _encode(self, values):
+        # float values (NaN for NOT_COMPUTED) -> stored values
+        values = np.asarray(values, dtype=np.float64)
+        if self.dtype != np.int8:
+            return values.astype(self.dtype)
+        missing = np.isnan(values)
+        encoded = np.where(missing, INT8_NOT_COMPUTED, np.round(np.clip(np.where(missing, 0.0, values), -1.0, 1.0) * INT8_SCALE))
+        return encoded.astype(np.int8)
+
+    def _decode(self, values):
+        # stored values -> float64, NaN for NOT_COMPUTED
+        if self.dtype != np.int8:
+            return np.asarray(values, dtype=np.float64)
+        values = np.asarray(values)
+        return np.where(values == INT8_NOT_COMPUTED, NOT_COMPUTED, values.astype(np.float64) / INT8_SCALE)
+
+    def astype(self, dtype):
+        """ copy of the store with the values kept as dtype, e.g. to measure the effect of a quantized store
+        """
+        object = CosineSimilarity(dtype = dtype, sparse = self.sparse, floor = self.floor)
+        object.rows = dict(self.rows)
+        object.cols = dict(self.cols)
+        if self.sparse:
+            object.indptr = np.array(self.indptr)
+            object.colids = np.array(self.colids)
+            object.values = object._encode(self._decode(self.values))
+            return object
+        object.matrix = np.empty(self.matrix.shape, dtype=object.dtype)
+        step = self._block_size(self.matrix.shape[1])
+        for start in range(0, self.matrix.shape[0], step):
+            object.matrix[start:start + step] = object._encode(self._decode(self.matrix[start:start + step]))
+        return object
+
+    def _add_phrases(self, predictions, references):
+        for p in predictions:
+            if p not in self.rows:
+                self.rows[p] = len(self.rows)
+        for r in references:
+            if r not in self.cols:
+                self.cols[r] = len(self.cols)
+
+    def _resize(self):
+        if self.sparse:
+            # new rows are empty, new columns do not change the CSR arrays
+            missing = len(self.rows) + 1 - len(self.indptr)
+            if missing > 0:
+                self.indptr = np.concatenate((self.indptr, np.full(missing, self.indptr[-1], dtype=np.int64)))
+            return
+        shape = (len(self.rows), len(self.cols))
+        if self.matrix.shape == shape and self.matrix.flags.writeable:
+            return # a memory-mapped store is read only, we work on a copy when it is updated
+        if self.path is None:
+            if self.buffer is None or shape[0] > self.buffer.shape[0] or shape[1] > self.buffer.shape[1]:
+                # the capacity grows by half (at least GROWTH_MIN) along the dimension that overflows,
+                # so adding the phrases a few at a time (e.g. procedure_deduplication) copies the matrix amortized O(1) times
+                capacity = shape
+                if self.buffer is not None:
+                    capacity = tuple(c if n <= c else max(n, c + max(c // 2, GROWTH_MIN)) for n, c in zip(shape, self.buffer.shape))
+                buffer = np.full(capacity, self._encode(NOT_COMPUTED), dtype=self.dtype)
+                old_rows, old_cols = self.matrix.shape
+                buffer[:old_rows, :old_cols] = self.matrix
+                self.buffer = buffer
+            self.matrix = self.buffer[:shape[0], :shape[1]]
+            return
+        # the new matrix goes straight to disk, copied a few rows at a time
+        # every resize gets its own temporary file (renamed by to_npy): the current matrix may be the memmap of the previous one
+        # and other processes may grow a store of the same path
+        handle, temp_file = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(self.path)), prefix = os.path.basename(self.path) + ".", suffix = ".tmp")
+        os.close(handle)
+        matrix = np.lib.format.open_memmap(temp_file, mode="w+", dtype=self.dtype, shape=shape)
+        old_rows, old_cols = self.matrix.shape
+        step = self._block_size(shape[1])
+        for start in range(0, shape[0], step):
+            end = min(start + step, shape[0])
+            matrix[start:end] = self._encode(NOT_COMPUTED)
+            if start < old_rows:
+                matrix[start:min(end, old_rows), :old_cols] = self.matrix[start:min(end, old_rows)]
+        old_temp_file = self.temp_file
+        self.matrix = matrix
+        self.temp_file = temp_file
+        if old_temp_file is not None:
+            os.remove(old_temp_file)
+
+    def _write(self, row_ids, col_ids, values, floor = None):
+        """ save values[i][j] for (row_ids[i], col_ids[j]), or values[i] for (row_ids[i], col_ids[i]) when values is 1-D
+            in sparse mode the values below floor (default self.floor) are dropped
+        """
+        if floor is None:
+            floor = self.floor
+        if not self.sparse:
+            if values.ndim == 2:
+                self.matrix[np.ix_(row_ids, col_ids)] = self._encode(values)
+            else:
+                self.matrix[row_ids, col_ids] = self._encode(values)
+            return
+        old_rows = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        old_cols = np.asarray(self.colids)
+        if values.ndim == 2:
+            # old entries inside the new block are replaced
+            replaced_rows = np.zeros(len(self.rows), dtype=bool)
+            replaced_rows[row_ids] = True
+            replaced_cols = np.zeros(len(self.cols), dtype=bool)
+            replaced_cols[col_ids] = True
+            replaced = replaced_rows[old_rows] & replaced_cols[old_cols]
+            new_rows = np.repeat(row_ids, len(col_ids))
+            new_cols = np.tile(col_ids, len(row_ids))
+            values = values.ravel()
+        else:
+            replaced = np.isin(old_rows * len(self.cols) + old_cols, row_ids * len(self.cols) + col_ids)
+            new_rows, new_cols = row_ids, col_ids
+        kept = values >= floor
+        self.total_pairs += len(values)
+        self.kept_pairs += int(kept.sum())
+        self._merge_sparse(replaced, new_rows[kept], new_cols[kept], values[kept])
+
+    def _merge_sparse(self, replaced, new_rows, new_cols, new_values):
+        # replaced: mask over the current CSR entries that are overwritten by the new entries
+        old_rows = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        all_rows = np.concatenate((old_rows[~replaced], new_rows))
+        all_cols = np.concatenate((np.asarray(self.colids)[~replaced], new_cols))
+        all_values = np.concatenate((np.asarray(self.values)[~replaced], self._encode(new_values)))
+        order = np.lexsort((all_cols, all_rows))
+        self.colids = all_cols[order].astype(np.int32)
+        self.values = all_values[order]
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(all_rows, minlength=len(self.rows))))).astype(np.int64)
+
+    def _read(self, rows, cols):
+        """ dense float64 block for known row ids x known col ids, missing pairs are NaN
+        """
+        if not self.sparse:
+            return self._decode(self.matrix[np.ix_(rows, cols)])
+        block = np.full((len(rows), len(cols)), NOT_COMPUTED, dtype=np.float64)
+        order = np.argsort(cols, kind="stable")
+        sorted_cols = cols[order]
+        for i in range(len(rows)):
+            start, end = self.indptr[rows[i]], self.indptr[rows[i] + 1]
+            if start == end:
+                continue
+            row_cols = self.colids[start:end]
+            position = np.searchsorted(row_cols, sorted_cols)
+            position[position == len(row_cols)] = 0
+            hit = row_cols[position] == sorted_cols
+            block[i, order[hit]] = self._decode(self.values[start:end][position[hit]])
+        return block
+
     def add(self, id1, id2, f1):
-        if id1 not in self.f1:
-            self.f1[id1] = {}
-        self.f1[id1][id2] = f1
-        if id2 not in self.f1:
-            self.f1[id2] = {}
-        self.f1[id2][id1] = f1
-    
+        self._add_phrases([id1], [id2])
+        self._resize()
+        self._write(np.array([self.rows[id1]]), np.array([self.cols[id2]]), np.array([f1], dtype=np.float64))
+
     #get f1 score between phrases
     def getf1(self, id1, id2):
-        try:
-            if id1 in self.f1:
-                return self.f1[id1][id2]
-            if id2 in self.f1:
-                return self.f1[id2][id1]
-        except:
-            # return self.compute([id1], [id2])
-            # because we calculate the similarity before hand and save it in a file
-            # so if we can't find the similarity between two phrases, return 0. we do not want to load new model herer
-            return 0
+        # the pair may be stored in either orientation
+        for p1, p2 in ((id1, id2), (id2, id1)):
+            r = self.rows.get(p1)
+            c = self.cols.get(p2)
+            if r is not None and c is not None:
+                value = float(self._read(np.array([r]), np.array([c]))[0, 0])
+                if not np.isnan(value):
+                    return value
+        # because we calculate the similarity before hand and save it in a file
+        # so if we can't find the similarity between two phrases, return 0. we do not want to load new model herer
         return 0
-        
+
     # #compute f1 score between procedures
     # def compute(self, input_texts, target_texts):
     #     f1 = []
@@ -59,75 +343,119 @@ class CosineSimilarity:
     #     f1 = rs["f1"]
     #     for i in range(len(input_texts)):
     #         self.add(input_texts[i], target_texts[i], f1[i])
-    
-
-    # def compute_range2(self, predictions, references, window_size = 100000, flag = True):
-    #     if flag:
-    #         combinations = list(itertools.product(predictions, references))
-    #     else:
-    #         combinations = list(zip(predictions, references))
-    #     combinations2 = [c for c in combinations if self.getf1(c[0], c[1]) == 0]
-    #     combinations = combinations2
-    #     for i in tqdm(range(0, len(combinations), window_size)):
-    #             end = i + window_size if i + window_size < len(combinations) else len(combinations)
-    #             data1 =[k[0] for k in combinations[i:end]]
-    #             data2 =[k[1] for k in combinations[i:end]]
-    #             self.compute(data1, data2)
-    
+
+    def embed(self, phrases):
+        if Keys.EMBEDDING_SERVER_ADDRESS is not None:
+            # the server owns the model and the cache
+            return embedding_server.get_client().embed(phrases)
+        if not Keys.EMBEDDING_CACHE_ENABLE:
+            return np.array(get_model()(phrases))
+        if self.cache is None:
+            self.cache = EmbeddingCache(Keys.EMBEDDING_CACHE_PATH)
+        # the model is only loaded when the cache misses
+        return self.cache.embed(phrases, lambda batch: get_model()(batch), batch_size = Keys.EMBEDDING_BATCH_SIZE)
+
     def compute_range(self, predictions, references, window_size = 100000, flag = True):
-        # predict_ = []
-        # reference_ = {}
-        # for p in predictions:
-        #     predict_.append(p)
-        #     for r in references:
-        #         if self.getf1(p, r) == 0 and r not in reference_:  
-        #             reference_[r] = 1
-        # predictions = predict_
-        # references = list(reference_.keys())
-        predict_embed = np.array(model(predictions))
-        reference_embed = np.array(model(references))
+        if len(predictions) == 0 or len(references) == 0:
+            return
+        if flag:
+            predictions = list(dict.fromkeys(predictions))
+            references = list(dict.fromkeys(references))
+        predict_embed = normalize(self.embed(predictions))
+        reference_embed = normalize(self.embed(references))
+        self._add_phrases(predictions, references)
+        self._resize()
+        row_ids = np.array([self.rows[p] for p in predictions], dtype=np.int64)
+        col_ids = np.array([self.cols[r] for r in references], dtype=np.int64)
         if flag:
-            combinations = list(itertools.product(predictions, references))
-            embed_combinations = list(itertools.product(predict_embed, reference_embed))
+            self._stream(row_ids, col_ids, predict_embed, reference_embed)
         else:
-            combinations = list(zip(predictions, references))
-            embed_combinations = list(zip(predict_embed, reference_embed))
-        # for i in tqdm(range(0, len(combinations))):
-        #         if self.getf1(combinations[i][0], combinations[i][1]) != 0:
-        #             continue
-        #         value = cosine_similarity(embed_combinations[i][0].reshape(1,-1), embed_combinations[i][1].reshape(1,-1))[0][0]
-        #         self.add(combinations[i][0], combinations[i][1], value)
-        cosine_values = cosine_similarity(predict_embed, reference_embed)
-        for i in range(len(predictions)):
-            for j in range(len(references)):
-                self.add(predictions[i], references[j], cosine_values[i][j])
-    # def compute_range2(self, predictions, references, window_size = 100000, flag = True):
-    #     # predict_ = []
-    #     # reference_ = {}
-    #     # for p in predictions:
-    #     #     predict_.append(p)
-    #     #     for r in references:
-    #     #         if self.getf1(p, r) == 0 and r not in reference_:  
-    #     #             reference_[r] = 1
-    #     # predictions = predict_
-    #     # references = list(reference_.keys())
-    #     predict_embed = np.array(model(predictions))
-    #     reference_embed = np.array(model(references))
-    #     if flag:
-    #         combinations = list(itertools.product(predictions, references))
-    #         embed_combinations = list(itertools.product(predict_embed, reference_embed))
-    #     else:
-    #         combinations = list(zip(predictions, references))
-    #         embed_combinations = list(zip(predict_embed, reference_embed))
-    #     for i in tqdm(range(0, len(combinations))):
-    #             if self.getf1(combinations[i][0], combinations[i][1]) != 0:
-    #                 continue
-    #             value = cosine_similarity(embed_combinations[i][0].reshape(1,-1), embed_combinations[i][1].reshape(1,-1))[0][0]
-    #             self.add(combinations[i][0], combinations[i][1], value)
-        # cosine_values = cosine_similarity(predict_embed, reference_embed)
-        # for i in range(len(predictions)):
-        #     for j in range(len(references)):
-        #         self.add(predictions[i], references[j], cosine_values[i][j])
+            # pairwise mode, predictions[i] is compared with references[i] only
+            self._write(row_ids, col_ids, np.sum(predict_embed * reference_embed, axis=1))
+        if self.sparse:
+            self.pruning_report()
+
+    def compute_blocks(self, blocks):
+        """ compute only the given blocks [(predictions, references, floor), ...], the other pairs stay NOT_COMPUTED
+            each phrase is embedded once even if it is used by several blocks
+        """
+        predictions = list(dict.fromkeys(p for block in blocks for p in block[0]))
+        references = list(dict.fromkeys(r for block in blocks for r in block[1]))
+        if len(predictions) == 0 or len(references) == 0:
+            return
+        predict_embed = normalize(self.embed(predictions))
+        reference_embed = normalize(self.embed(references))
+        predict_order = {p: i for i, p in enumerate(predictions)}
+        reference_order = {r: i for i, r in enumerate(references)}
+        self._add_phrases(predictions, references)
+        self._resize()
+        computed = 0
+        for block_predictions, block_references, floor in blocks:
+            if len(block_predictions) == 0 or len(block_references) == 0:
+                continue
+            p_ids = np.array([predict_order[p] for p in block_predictions], dtype=np.int64)
+            r_ids = np.array([reference_order[r] for r in block_references], dtype=np.int64)
+            row_ids = np.array([self.rows[p] for p in block_predictions], dtype=np.int64)
+            col_ids = np.array([self.cols[r] for r in block_references], dtype=np.int64)
+            self._stream(row_ids, col_ids, predict_embed[p_ids], reference_embed[r_ids], floor)
+            computed += len(p_ids) * len(r_ids)
+        full = len(predictions) * len(references)
+        print(f"similarity store: computed {computed} of {full} phrase pairs in {len(blocks)} label blocks, {full - computed} pairs can not be used by alignment")
+        if self.sparse:
+            self.pruning_report()
+
+    def _block_size(self, n_rows):
+        # number of columns per block so that one block stays under Keys.SIMILARITY_MEMORY_LIMIT_MB
+        limit = Keys.SIMILARITY_MEMORY_LIMIT_MB * 1024 * 1024
+        return int(max(1, min(Keys.SIMILARITY_BLOCK_SIZE, limit // (max(n_rows, 1) * BLOCK_BYTES_PER_PAIR[self.sparse]))))
+
+    def _stream(self, row_ids, col_ids, predict_embed, reference_embed, floor = None):
+        """ write the cosine block predictions x references, a few reference phrases at a time
+            the embeddings must be normalized, so each block is a single matmul
+        """
+        if floor is None:
+            floor = self.floor
+        step = self._block_size(len(row_ids))
+        blocks = range(0, len(col_ids), step)
+        if len(blocks) > 1:
+            blocks = tqdm(blocks, desc="cosine similarity", unit="block")
+        new_rows, new_cols, new_values = [], [], []
+        for start in blocks:
+            end = min(start + step, len(col_ids))
+            values = predict_embed @ reference_embed[start:end].T
+            if not self.sparse:
+                self._write(row_ids, col_ids[start:end], values)
+                continue
+            # only the kept pairs of each block are held, the CSR arrays are rebuilt once at the end
+            kept_rows, kept_cols = np.nonzero(values >= floor)
+            new_rows.append(row_ids[kept_rows])
+            new_cols.append(col_ids[start:end][kept_cols])
+            new_values.append(values[kept_rows, kept_cols])
+            self.total_pairs += values.size
+            self.kept_pairs += len(kept_rows)
+        if not self.sparse or len(new_rows) == 0:
+            return
+        old_rows = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        replaced_rows = np.zeros(len(self.rows), dtype=bool)
+        replaced_rows[row_ids] = True
+        replaced_cols = np.zeros(len(self.cols), dtype=bool)
+        replaced_cols[col_ids] = True
+        replaced = replaced_rows[old_rows] & replaced_cols[np.asarray(self.colids)]
+        self._merge_sparse(replaced, np.concatenate(new_rows), np.concatenate(new_cols), np.concatenate(new_values))
+
+    def pruning_report(self):
+        pruned = self.total_pairs - self.kept_pairs
+        ratio = 100.0 * pruned / self.total_pairs if self.total_pairs > 0 else 0.0
+        print(f"similarity store: kept {self.kept_pairs} of {self.total_pairs} pairs, pruned {pruned} ({ratio:.1f}%) below floor {self.floor:.3f}")
+        return {"total": self.total_pairs, "kept": self.kept_pairs, "pruned": pruned}
+
+    def cache_report(self):
+        """ embedding cache totals since the store was created, printed once per run by its callers
+        """
+        if self.cache is None:
+            return None
+        print(f"embedding cache: {self.cache.hits} hits, {self.cache.misses} phrases encoded")
+        return {"hits": self.cache.hits, "misses": self.cache.misses}
     # def cosine_sim(self, w1, w2):
     #     value = 0
     #     try:
@@ -147,14 +475,62 @@ class CosineSimilarity:
         self.compute_range(predictions, references, window_size = 1, flag = False)
         return self.getf1(input1, input2)
 
+    def indices(self, phrases):
+        """ resolve phrases once into (row indices, column indices), -1 when the phrase is unknown
+            the result can be passed to max_similarity/max_similarity_bulk as many times as needed
+        """
+        rows = np.array([self.rows.get(p, -1) for p in phrases], dtype=np.int64)
+        cols = np.array([self.cols.get(p, -1) for p in phrases], dtype=np.int64)
+        return rows, cols
 
+    def _block(self, rows, cols):
+        # sub-matrix between known rows and known cols, values are read with one fancy index
+        rows = rows[rows >= 0]
+        cols = cols[cols >= 0]
+        if len(rows) == 0 or len(cols) == 0:
+            return None
+        return self._read(rows, cols)
 
-    def get_similarity(self, input1, input2):
+    def max_similarity(self, index1, index2):
+        """ max similarity between two resolved phrase lists, same value as get_similarity
+        """
         max_f1 = 0.0
-        for i in range(len(input1)):
-            for j in range(len(input2)):
-                f_value = self.getf1(input1[i], input2[j])
-                if f_value > max_f1:
-                    max_f1 = f_value
-        return max_f1
-    
+        # phrase pairs are looked up in both orientations, like getf1
+        for rows, cols in ((index1[0], index2[1]), (index2[0], index1[1])):
+            block = self._block(rows, cols)
+            if block is not None:
+                # fmax skips the pairs that were not computed
+                max_f1 = np.fmax(max_f1, np.fmax.reduce(block, axis=None))
+        return float(max_f1)
+
+    def max_similarity_bulk(self, index1, indexes2):
+        """ max similarity between one resolved phrase list (e.g. a procedure node) and
+            a list of resolved phrase lists (e.g. all campaign nodes), computed in one call
+        """
+        result = np.zeros(len(indexes2), dtype=np.float64)
+        if len(indexes2) == 0:
+            return result
+        lengths = np.array([len(index[0]) for index in indexes2], dtype=np.int64)
+        if lengths.sum() == 0:
+            return result
+        rows2 = np.concatenate([index[0] for index in indexes2])
+        cols2 = np.concatenate([index[1] for index in indexes2])
+        # best value for each phrase of indexes2, missing pairs count as 0
+        phrase_max = np.zeros(len(rows2), dtype=np.float64)
+        rows1 = index1[0][index1[0] >= 0]
+        known = cols2 >= 0
+        if len(rows1) > 0 and known.any():
+            block = self._read(rows1, cols2[known])
+            phrase_max[known] = np.fmax(phrase_max[known], np.fmax.reduce(block, axis=0))
+        cols1 = index1[1][index1[1] >= 0]
+        known = rows2 >= 0
+        if len(cols1) > 0 and known.any():
+            block = self._read(rows2[known], cols1)
+            phrase_max[known] = np.fmax(phrase_max[known], np.fmax.reduce(block, axis=1))
+        non_empty = lengths > 0
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        result[non_empty] = np.maximum.reduceat(phrase_max, starts[non_empty])
+        return result
+
+    def get_similarity(self, input1, input2):
+        return self.max_similarity(self.indices(input1), self.indices(input2))
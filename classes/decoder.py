@@ -9,6 +9,7 @@ from classes.cosine_similarity import CosineSimilarity
 from mitre_attack import *
 procedure_mapper = proID_techID
 from language_models import *
+from classes.lexical_cache import lexical_tokens
 from mitre_attack import MitreAttack
 must_be_focus= r"\b(email|keylogger|privilege|credential)"
 def phrase_ranking(phrase):
@@ -16,16 +17,15 @@ def phrase_ranking(phrase):
     #     return 0.5
     if phrase.lower() in ["any", "anyone", "anything", "anywhere","that","this","these","those"]:
         return 4
-    doc = nlp(phrase)
-    tokens = [t for t in doc]
-    if len(tokens) == 1 and tokens[0].pos_ == "PRON":
+    tokens = lexical_tokens(phrase)
+    if len(tokens) == 1 and tokens[0][2] == "PRON":
         return 4 #proper noun
     flag = False
-    for t in tokens:
-        if t.pos_ == "PROPN":
+    for text, lemma, pos in tokens:
+        if pos == "PROPN":
             flag = True
             break
-        for c in t.text:
+        for c in text:
             if c.isupper():
                 flag = True
                 break
@@ -0,0 +1,95 @@
+import numpy as np
+import networkx as nx
+from keys import Keys
+
+UNREACHABLE = 100 # hop distance used by graph_alignment when there is no path between two nodes
+
+
+SAME_SENTENCE = (0.0, 0.1, 0.15) # distance3 of get_sent_distance for two ids of the same sentence, by id distance (<= 10, <= 20, > 20)
+NO_PAIR = len(SAME_SENTENCE) # no two ids of the nodes are in the same sentence
+BLOCK_PAIRS = 1 << 20 # id pairs per block when the sentence distances are built
+
+
+class DistanceIndex():
+    """ all-pairs distances of a campaign (chunk) graph, built once and read in O(1) by graph_alignment
+        hops[i][j]: shortest path length in campaign.graph, UNREACHABLE if there is no path
+        near[i][j]: smallest sentence distance (> 0) between the ids of the two nodes, no_sentence if every pair shares a sentence
+        same[i][j]: smallest SAME_SENTENCE index of the ids of the two nodes sharing a sentence, NO_PAIR if there is none
+        sent_distance rebuilds Alignment.get_sent_distance from near and same with the same float operations
+        rows/columns follow the sorted node ids of campaign.graph_nodes
+    """
+    def __init__(self, campaign):
+        self.node_ids = sorted(campaign.graph_nodes.keys())
+        self.position = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        self.hops = self._hop_matrix(campaign.graph)
+        self.user = np.array(["USER" in campaign.graph_nodes[node_id]["meta"]["label"] for node_id in self.node_ids], dtype=bool)
+        self.near, self.same = self._sent_matrices(campaign.graph_nodes)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def _hop_matrix(self, graph):
+        n = len(self.node_ids)
+        hops = np.full((n, n), UNREACHABLE, dtype=np.int16)
+        for node_id in self.node_ids:
+            if node_id not in graph:
+                continue # networkx raises for a missing node, graph_alignment reads it as unreachable
+            i = self.position[node_id]
+            for target, length in nx.single_source_shortest_path_length(graph, node_id).items():
+                j = self.position.get(target)
+                if j is not None:
+                    hops[i, j] = min(length, UNREACHABLE)
+        return hops
+
+    def _sent_matrices(self, graph_nodes):
+        """ near and same of every pair of nodes, reduced over the ids of a few nodes (BLOCK_PAIRS id pairs) at a time
+        """
+        n = len(self.node_ids)
+        ids = list()
+        owners = list()
+        for i, node_id in enumerate(self.node_ids):
+            meta = graph_nodes[node_id]["meta"]
+            node_ids = meta["ids"] if "ids" in meta else [graph_nodes[node_id]["id"]]
+            ids.extend(node_ids)
+            owners.extend([i] * len(node_ids))
+        ids = np.array(ids, dtype=np.int64)
+        sents = ids // 1000
+        starts = np.searchsorted(np.array(owners, dtype=np.int64), np.arange(n + 1))
+        dtype = np.int16 if len(sents) == 0 or int(sents.max() - sents.min()) < np.iinfo(np.int16).max else np.int32
+        self.no_sentence = np.iinfo(dtype).max
+        near = np.empty((n, n), dtype=dtype)
+        same = np.empty((n, n), dtype=np.int8)
+        a = 0
+        while a < n:
+            # nodes a..b-1, at least one, with at most BLOCK_PAIRS id pairs
+            b = a + 1
+            while b < n and (starts[b + 1] - starts[a]) * len(ids) <= BLOCK_PAIRS:
+                b += 1
+            rows = slice(starts[a], starts[b])
+            sent_diff = np.abs(sents[rows, None] - sents[None, :])
+            id_diff = np.abs(ids[rows, None] - ids[None, :])
+            block_same = np.where(sent_diff == 0, np.where(id_diff > 20, 2, np.where(id_diff > 10, 1, 0)), NO_PAIR)
+            block_near = np.where(sent_diff > 0, sent_diff, self.no_sentence)
+            # min over the ids of each node, first along the rows then along the columns
+            row_starts = starts[a:b] - starts[a]
+            if len(ids) > 0:
+                near[a:b] = np.minimum.reduceat(np.minimum.reduceat(block_near, row_starts, axis=0), starts[:n], axis=1)
+                same[a:b] = np.minimum.reduceat(np.minimum.reduceat(block_same, row_starts, axis=0), starts[:n], axis=1)
+            a = b
+        return near, same
+
+    def hop_distance(self, source, dest):
+        return int(self.hops[self.position[source], self.position[dest]])
+
+    def sent_distance(self, source, dest):
+        i, j = self.position[source], self.position[dest]
+        FACTOR = Keys.DISTANCE_FACTOR_PER_SENTENCE
+        if self.user[i] or self.user[j]:
+            FACTOR *= 0.5 # tolerate the distance between user and other nodes
+        distances = []
+        # 1 + FACTOR * distance2 + distance3 is increasing in distance2, its min is the one of the smallest distance2
+        if self.same[i, j] != NO_PAIR:
+            distances.append(1 + FACTOR * 0 + SAME_SENTENCE[self.same[i, j]])
+        if self.near[i, j] != self.no_sentence:
+            distances.append(1 + FACTOR * int(self.near[i, j]) + 0.0)
+        return min(distances)
@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+import numpy as np
+from keys import Keys
+
+
+def normalize_phrase(phrase: str):
+    # only the spacing is normalized, the encoder is case sensitive so we keep the case
+    return " ".join(phrase.split())
+
+
+def phrase_key(phrase: str):
+    return hashlib.sha1(normalize_phrase(phrase).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache():
+    """ on-disk cache of phrase embeddings, keyed by the hash of the normalized phrase
+        every flush appends a new shard (shard_xxxxx.npy + shard_xxxxx.json with the keys),
+        old shards are never rewritten so the cache can grow run after run
+        with dtype int8 each vector is stored as int8 with its own scale (shard_xxxxx.scale.npy)
+    """
+    def __init__(self, path: str = Keys.EMBEDDING_CACHE_PATH, dtype: str = Keys.EMBEDDING_DTYPE):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.index = dict() # key -> (shard number, row)
+        self.shards = list()
+        self.scales = list() # per-row scales of the int8 shards, None for float shards
+        self.pending_keys = list()
+        self.pending_vectors = list()
+        self.hits = 0
+        self.misses = 0
+        if os.path.isdir(self.path):
+            self._load()
+
+    def _shard_path(self, number: int):
+        return os.path.join(self.path, f"shard_{number:05d}")
+
+    def _load(self):
+        number = 0
+        while os.path.exists(self._shard_path(number) + ".json"):
+            shard_path = self._shard_path(number)
+            with open(shard_path + ".json", "r") as f:
+                keys = json.load(f)
+            self.shards.append(np.load(shard_path + ".npy", mmap_mode="r"))
+            self.scales.append(np.load(shard_path + ".scale.npy") if os.path.exists(shard_path + ".scale.npy") else None)
+            for row, key in enumerate(keys):
+                self.index[key] = (number, row)
+            number += 1
+
+    def __len__(self):
+        return len(self.index) + len(self.pending_keys)
+
+    def _get(self, key):
+        shard, row = self.index[key]
+        if shard == len(self.shards):
+            return self.pending_vectors[row]
+        if self.scales[shard] is not None:
+            return self.shards[shard][row].astype(np.float32) * self.scales[shard][row]
+        return self.shards[shard][row]
+
+    def put(self, phrases: list, vectors):
+        for phrase, vector in zip(phrases, vectors):
+            key = phrase_key(phrase)
+            if key in self.index:
+                continue
+            self.index[key] = (len(self.shards), len(self.pending_keys))
+            self.pending_keys.append(key)
+            self.pending_vectors.append(np.asarray(vector, dtype=np.float32))
+
+    def flush(self):
+        if len(self.pending_keys) == 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        shard_path = self._shard_path(len(self.shards))
+        vectors = np.stack(self.pending_vectors)
+        scales = None
+        if self.dtype == np.int8:
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            vectors = np.round(vectors / scales[:, None]).astype(np.int8)
+            np.save(shard_path + ".scale.npy", scales.astype(np.float32))
+        else:
+            vectors = vectors.astype(self.dtype)
+        # the keys are written last, a shard without keys is ignored by the next run
+        np.save(shard_path + ".npy", vectors)
+        with open(shard_path + ".json", "w") as f:
+            json.dump(self.pending_keys, f)
+        self.shards.append(np.load(shard_path + ".npy", mmap_mode="r"))
+        self.scales.append(np.load(shard_path + ".scale.npy") if scales is not None else None)
+        self.pending_keys = list()
+        self.pending_vectors = list()
+
+    def embed(self, phrases: list, encoder, batch_size: int = Keys.EMBEDDING_BATCH_SIZE):
+        """ return the embeddings of phrases (same order), only the cache misses are sent to the encoder
+        """
+        misses = list()
+        unique = set()
+        for phrase in phrases:
+            key = phrase_key(phrase)
+            if key in self.index or key in unique:
+                continue
+            unique.add(key)
+            misses.append(phrase)
+        self.misses += len(misses)
+        self.hits += len(phrases) - len(misses)
+        for i in range(0, len(misses), batch_size):
+            batch = misses[i:i + batch_size]
+            self.put(batch, np.array(encoder(batch)))
+        self.flush()
+        if len(phrases) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([self._get(phrase_key(phrase)) for phrase in phrases]).astype(np.float32)
@@ -0,0 +1,192 @@
+import time
+import queue
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from keys import Keys
+from classes.embedding_cache import EmbeddingCache
+
+
+class EmbeddingServer():
+    """ one process owns the sentence encoder and answers the phrase lists sent by the other processes
+        requests that arrive together are coalesced into one micro-batch, deduplicated and checked against the cache
+        protocol: ("embed", phrases) -> ("ok", vectors) or ("error", message), ("stop",) shuts the server down
+    """
+    def __init__(self, address = Keys.EMBEDDING_SERVER_ADDRESS, authkey: bytes = Keys.EMBEDDING_SERVER_AUTHKEY, encoder = None, cache_path: str = Keys.EMBEDDING_CACHE_PATH):
+        self.address = address
+        self.authkey = authkey
+        self.encoder = encoder # phrases -> vectors, default is the Universal Sentence Encoder
+        self.cache = EmbeddingCache(cache_path) if cache_path is not None else None
+        self.requests = queue.Queue()
+        self.running = False
+        self.batches = 0
+        self.served_requests = 0
+        self.served_phrases = 0
+
+    def _encode(self, phrases: list):
+        encoder = self.encoder
+        if encoder is None:
+            from classes.cosine_similarity import get_model
+            model = get_model()
+            encoder = lambda batch: model(batch)
+        if self.cache is None:
+            return np.array(encoder(phrases), dtype=np.float32)
+        return self.cache.embed(phrases, encoder, batch_size = Keys.EMBEDDING_BATCH_SIZE)
+
+    def _next_batch(self):
+        # wait for one request, then collect the ones arriving within EMBEDDING_SERVER_WAIT seconds
+        try:
+            batch = [self.requests.get(timeout = 0.1)]
+        except queue.Empty:
+            return []
+        size = len(batch[0][0])
+        deadline = time.time() + Keys.EMBEDDING_SERVER_WAIT
+        while size < Keys.EMBEDDING_SERVER_BATCH_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout = remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _batch_loop(self):
+        while self.running:
+            batch = self._next_batch()
+            if len(batch) == 0:
+                continue
+            phrases = list(dict.fromkeys(p for request in batch for p in request[0]))
+            try:
+                vectors = self._encode(phrases) if len(phrases) > 0 else np.zeros((0, 0), dtype=np.float32)
+                index = {p: i for i, p in enumerate(phrases)}
+                for request_phrases, reply in batch:
+                    reply.put(("ok", vectors[[index[p] for p in request_phrases]]))
+            except Exception as e:
+                for _, reply in batch:
+                    reply.put(("error", repr(e)))
+            self.batches += 1
+            self.served_requests += len(batch)
+            self.served_phrases += len(phrases)
+
+    def _handle(self, connection):
+        reply = queue.Queue(maxsize = 1)
+        try:
+            while self.running:
+                message = connection.recv()
+                if message[0] == "stop":
+                    self.stop()
+                    break
+                if message[0] != "embed":
+                    connection.send(("error", f"unknown request {message[0]}"))
+                    continue
+                self.requests.put((list(message[1]), reply))
+                connection.send(reply.get())
+        except (EOFError, OSError):
+            pass # the client is gone
+        finally:
+            connection.close()
+
+    def serve_forever(self):
+        self.running = True
+        batcher = threading.Thread(target = self._batch_loop, daemon = True)
+        batcher.start()
+        with Listener(self.address, backlog = 128, authkey = self.authkey) as listener:
+            print(f"embedding server listening on {listener.address}")
+            while self.running:
+                connection = listener.accept()
+                if not self.running:
+                    connection.close()
+                    break
+                threading.Thread(target = self._handle, args = (connection,), daemon = True).start()
+        batcher.join()
+        print(f"embedding server stopped: {self.served_requests} requests, {self.served_phrases} unique phrases in {self.batches} batches")
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        # wake up the blocking accept
+        try:
+            Client(self.address, authkey = self.authkey).close()
+        except OSError:
+            pass
+
+
+class EmbeddingClient():
+    def __init__(self, address = Keys.EMBEDDING_SERVER_ADDRESS, authkey: bytes = Keys.EMBEDDING_SERVER_AUTHKEY):
+        self.connection = Client(address, authkey = authkey)
+
+    def embed(self, phrases: list):
+        self.connection.send(("embed", list(phrases)))
+        status, value = self.connection.recv()
+        if status != "ok":
+            raise RuntimeError(f"embedding server failed: {value}")
+        return value
+
+    def stop_server(self):
+        self.connection.send(("stop",))
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+
+def run_server(address = Keys.EMBEDDING_SERVER_ADDRESS, authkey: bytes = Keys.EMBEDDING_SERVER_AUTHKEY, cache_path: str = Keys.EMBEDDING_CACHE_PATH):
+    EmbeddingServer(address, authkey, cache_path = cache_path).serve_forever()
+
+
+def server_running(address = Keys.EMBEDDING_SERVER_ADDRESS, authkey: bytes = Keys.EMBEDDING_SERVER_AUTHKEY):
+    try:
+        Client(address, authkey = authkey).close()
+        return True
+    except OSError:
+        return False
+
+
+def start_server(address = Keys.EMBEDDING_SERVER_ADDRESS, authkey: bytes = Keys.EMBEDDING_SERVER_AUTHKEY, timeout: float = 60.0):
+    """ start the server in a child process and wait until it accepts connections
+        return None when a server already answers on address, e.g. one started by another process at the same time
+    """
+    if server_running(address, authkey):
+        return None
+    process = mp.Process(target = run_server, args = (address, authkey), daemon = True)
+    process.start()
+    start = time.time()
+    while True:
+        if server_running(address, authkey):
+            # the child exits when another server bound the address first
+            return process if process.is_alive() else None
+        if not process.is_alive() or time.time() - start > timeout:
+            raise RuntimeError(f"embedding server did not start on {address}")
+        time.sleep(0.2)
+
+
+def ensure_server():
+    """ start the server at Keys.EMBEDDING_SERVER_ADDRESS if nobody listens there, without connecting to it
+        called by the parent before a worker pool, so that the workers only connect
+    """
+    if Keys.EMBEDDING_SERVER_ADDRESS is not None:
+        start_server(Keys.EMBEDDING_SERVER_ADDRESS, Keys.EMBEDDING_SERVER_AUTHKEY)
+
+
+_client = None
+def get_client():
+    """ client of the server at Keys.EMBEDDING_SERVER_ADDRESS, the server is started if nobody listens there
+    """
+    global _client
+    if _client is None:
+        address, authkey = Keys.EMBEDDING_SERVER_ADDRESS, Keys.EMBEDDING_SERVER_AUTHKEY
+        try:
+            _client = EmbeddingClient(address, authkey)
+        except OSError:
+            start_server(address, authkey)
+            _client = EmbeddingClient(address, authkey)
+    return _client
+
+
+if __name__ == "__main__":
+    run_server()
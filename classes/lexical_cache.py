@@ -0,0 +1,51 @@
+import functools
+import spacy
+from spacy.tokens import Doc
+from keys import Keys
+from language_models import nlp
+
+# word -> (pos_, tag_, lemma_) of the tokens made up by the extraction, e.g. the subject and verb added by via_handling
+SYNTHETIC_TOKENS = {
+    "Attacker": ("NOUN", "NN", "attacker"),
+    "use": ("VERB", "VB", "use"),
+}
+lexical_nlp = None
+
+
+def get_lexical_nlp():
+    """ the pipeline of the lemma/POS lookups: Keys.LEXICAL_MODEL without parser and ner, tokenizing like nlp
+        the transformer pipeline when the model is not installed or Keys.LEXICAL_MODEL is ""
+    """
+    global lexical_nlp
+    if lexical_nlp is None:
+        lexical_nlp = nlp
+        if Keys.LEXICAL_MODEL:
+            try:
+                lexical_nlp = spacy.load(Keys.LEXICAL_MODEL, exclude = ["parser", "ner"])
+                lexical_nlp.tokenizer.infix_finditer = nlp.tokenizer.infix_finditer
+            except OSError:
+                print(f"{Keys.LEXICAL_MODEL} is not installed, the lemma/POS lookups use the transformer pipeline")
+    return lexical_nlp
+
+
+@functools.lru_cache(maxsize = Keys.LEXICAL_CACHE_SIZE)
+def lexical_tokens(text: str):
+    """ (text, lemma_, pos_) of every token of text
+    """
+    return tuple((t.text, t.lemma_, t.pos_) for t in get_lexical_nlp()(text))
+
+
+def get_lemma(word: str):
+    tokens = lexical_tokens(word)
+    if len(tokens) == 1:
+        return tokens[0][1]
+    return word
+
+
+@functools.lru_cache(maxsize = None)
+def synthetic_token(word: str):
+    """ a token of word annotated from SYNTHETIC_TOKENS, built once per process instead of parsing the word
+    """
+    pos, tag, lemma = SYNTHETIC_TOKENS[word]
+    doc = Doc(nlp.vocab, words = [word], spaces = [False], pos = [pos], tags = [tag], lemmas = [lemma], deps = ["ROOT"], heads = [0])
+    return doc[0]
@@ -2,8 +2,9 @@ from classes.campaign import Campaign
 from classes.big_campaign import BigCampaign
 from classes.procedure import Procedure
 from classes.technique import Technique
-from classes.alignment_multiprocessing import Alignment
-from classes.cosine_similarity import CosineSimilarity
+from classes.alignment_multiprocessing import Alignment, alignment_pool, campaign_chunks
+from classes import alignment_multiprocessing
+from classes.cosine_similarity import CosineSimilarity, vocab_path
 
 from classes.decoder import Decoder
 from keys import Keys
@@ -20,6 +21,8 @@ campaigns_tech_alignment_dir = campaigns_dir + "/tech_alignment"
 campaigns_decoding_result = campaigns_dir + "/decoding_result"
 campaigns_sequence_techniques = campaigns_dir + "/sequence_techniques"
 campaigns_bert= campaigns_dir + "/USE_cosine"
+# not in campaigns_procedure_alignment_dir, report_decoding reads every .json there as a mapper
+campaigns_run_stats_file = campaigns_dir + "/run_stats.json"
 procedures_dir = Keys.PROCEDURE_PATH
 procedures_output_dir = procedures_dir + "/output"
 procedures_output_file = procedures_dir + "/analyzed_procedure.jsonl"
@@ -98,10 +101,14 @@ class Manager():
                 print("read procedure from text")
                 # since we need to access GPU for bert, we need to read procedure one by one to be faster
                 time1 = timeit.default_timer()
-                self.analyze_procedures_from_text(procedure_input_dir)
+                if Keys.PROCEDURE_PIPE:
+                    self.analyze_procedures_from_text_pipe(procedure_input_dir, procedures_output_file)
+                else:
+                    self.analyze_procedures_from_text(procedure_input_dir)
                 time2 = timeit.default_timer()
                 time_recoder["procedure_analyzing"] = time2 - time1
-                self.generate_procedure_jsonl(procedures_output_dir, procedures_output_file)
+                if not Keys.PROCEDURE_PIPE:
+                    self.generate_procedure_jsonl(procedures_output_dir, procedures_output_file)
                 self.load_procedures_from_json(load_from_jsonl = True)
                 is_knowledge_loaded = True
                 # self.write_pro_to_json()
@@ -183,27 +190,20 @@ class Manager():
         if len(self.big_campaigns) > 0:
             if Keys.MULTI_PROCESSING:
                 for campaign in self.big_campaigns:
-                    bert_sim_path = os.path.join(campaigns_bert, f"{campaign.id}.pkl")
+                    bert_sim_path = os.path.join(campaigns_bert, f"{campaign.id}.npy")
                     print("calculating bert similarity model")
-                    bert_similarity = CosineSimilarity()
-                    procedures_phrases = get_procedure_phrases(self.procedures)
-                    campaign_phrases = campaign.phrases
-                    bert_similarity.compute_range(procedures_phrases,campaign_phrases )
-                    bert_similarity.to_pickle(bert_sim_path)
+                    bert_similarity = CosineSimilarity(sparse = Keys.SIMILARITY_SPARSE, path = bert_sim_path)
+                    if Keys.SIMILARITY_LABEL_PARTITION:
+                        bert_similarity.compute_blocks(Alignment.similarity_blocks(self.procedures.values(), campaign.data))
+                    else:
+                        procedures_phrases = get_procedure_phrases(self.procedures)
+                        campaign_phrases = campaign.phrases
+                        bert_similarity.compute_range(procedures_phrases,campaign_phrases )
+                    bert_similarity.cache_report()
+                    bert_similarity.to_npy(bert_sim_path)
                     campaign.bert_path = bert_sim_path
             else: #no multiprocessing, we stack all of phrases into a big one
-                bert_sim_path = os.path.join(campaigns_bert, f"all.pkl")
-                if os.path.exists(bert_sim_path):
-                    bert_similarity = CosineSimilarity.from_pickle(bert_sim_path)
-                else:
-                    bert_similarity = CosineSimilarity()
-                procedures_phrases = get_procedure_phrases(self.procedures)
-                campaign_phrases = []
-                for campaign in self.big_campaigns:
-                    campaign_phrases.extend(campaign.phrases)
-                campaign_phrases = list(set(campaign_phrases))
-                bert_similarity.compute_range(procedures_phrases,campaign_phrases )
-                bert_similarity.to_pickle(bert_sim_path)
+                self.generate_shared_bert_object()
         # if len(self.campaigns) > 0 and len(self.big_campaigns) == 0:
         #     for  campaign in self.campaigns:
         #         bert_sim_path = os.path.join(campaigns_bert, f"{campaign.id}.pkl")
@@ -295,7 +295,48 @@ class Manager():
         for i in range(0,len(procedures)):
             generate_procedure(procedures, i)
 
-    
+    def analyze_procedures_from_text_pipe(self, path: str, output_file: str = procedures_output_file):
+        """
+        Read procedures from the given path, parse them with nlp.pipe and write them to the jsonl store,
+        skipping the procedures that generate_procedure would not write.
+        The store is written to a temporary file that replaces output_file once every procedure is done
+        """
+        procedures = pd.read_csv(path)
+        rows = []
+        for i in range(0,len(procedures)):
+            tech_id = procedures.loc[i, "tech_id"]
+            procedure_id = procedures.loc[i, "id"]
+            image_path = os.path.join(procedures_image_dir, f"{procedure_id}.png") if Keys.IMAGE_GENERATION else ""
+            rows.append({"text": procedures.loc[i, "description"], "tech_id": tech_id, "procedure_id": procedure_id, "special_id": tech_id, "image_path": image_path})
+        chunk_size = max(1, Keys.PROCEDURE_PIPE_CHUNK_SIZE)
+        written, error_ids = 0, []
+        temp_file = output_file + ".tmp"
+        start = timeit.default_timer()
+        with jsonlines.open(temp_file, mode ='w') as writer:
+            for chunk_start in range(0, len(rows), chunk_size):
+                chunk = rows[chunk_start:chunk_start + chunk_size]
+                for row, _procedure, error in Procedure.pipe(chunk, batch_size = Keys.PROCEDURE_PIPE_BATCH_SIZE, n_process = Keys.PROCEDURE_PIPE_PROCESSES):
+                    if error is not None:
+                        print(f"procedure {row['procedure_id']} failed: {error!r}")
+                        error_ids.append(row["procedure_id"])
+                        continue
+                    _procedure.remove_none_entity_node()
+                    if len(_procedure.graph_nodes) == 0 or len(_procedure.graph_edges) == 0:
+                        error_ids.append(_procedure.id)
+                        continue
+                    try:
+                        writer.write(_procedure.to_dict())
+                        written += 1
+                    except:
+                        error_ids.append(_procedure.id)
+                done = chunk_start + len(chunk)
+                seconds = timeit.default_timer() - start
+                print(f"procedures: {done}/{len(rows)}, written {written}, {done/seconds:.2f} docs/sec")
+        os.replace(temp_file, output_file)
+        seconds = timeit.default_timer() - start
+        print(f"analyzed {len(rows)} procedures in {seconds:.1f}s ({len(rows)/max(seconds, 1e-9):.2f} docs/sec), {written} written to {output_file}, {len(error_ids)} failed or without graph")
+        return error_ids
+
     def analyze_campaign_from_text(self, path: str):
         """
         Read campaign from the given path
@@ -392,55 +433,128 @@ class Manager():
                 campaign = pickle.load(open(file_path, "rb"))
                 self.campaigns.append(campaign)
     
+    def generate_shared_bert_object(self, bert_sim_path = os.path.join(campaigns_bert, "all.npy")):
+        """ build or extend all.npy, the similarity store of every loaded report, used when MULTI_PROCESSING is off and by the cross-report alignment
+        """
+        legacy_sim_path = os.path.splitext(bert_sim_path)[0] + ".pkl"
+        if os.path.exists(bert_sim_path):
+            bert_similarity = CosineSimilarity.from_file(bert_sim_path, writable = True)
+        elif os.path.exists(legacy_sim_path):
+            bert_similarity = CosineSimilarity.from_file(legacy_sim_path) # convert the old dict-of-dicts pickle
+        else:
+            bert_similarity = CosineSimilarity(sparse = Keys.SIMILARITY_SPARSE, path = bert_sim_path)
+        if Keys.SIMILARITY_LABEL_PARTITION:
+            campaigns = [c for campaign in self.big_campaigns for c in campaign.data]
+            bert_similarity.compute_blocks(Alignment.similarity_blocks(self.procedures.values(), campaigns))
+        else:
+            procedures_phrases = get_procedure_phrases(self.procedures)
+            campaign_phrases = []
+            for campaign in self.big_campaigns:
+                campaign_phrases.extend(campaign.phrases)
+            campaign_phrases = list(set(campaign_phrases))
+            bert_similarity.compute_range(procedures_phrases,campaign_phrases )
+        bert_similarity.cache_report()
+        bert_similarity.to_npy(bert_sim_path)
+
+    def shared_bert_object_covers(self, bert_sim_path = os.path.join(campaigns_bert, "all.npy")):
+        """ all.npy exists and has the phrases of every loaded procedure (rows) and report chunk (columns)
+        """
+        if not os.path.exists(bert_sim_path) or not os.path.exists(vocab_path(bert_sim_path)):
+            return False
+        with open(vocab_path(bert_sim_path), "r") as f:
+            vocab = json.load(f)
+        rows, cols = set(vocab["rows"]), set(vocab["cols"])
+        for procedure in self.procedures.values():
+            if not rows.issuperset(procedure.get_phrase_nodes()):
+                return False
+        for campaign in self.big_campaigns:
+            for c in campaign.data:
+                if not cols.issuperset(c.get_phrase_nodes()):
+                    return False
+        return True
+
     def procedure_matching(self):
         #todo: flatten the big campaign or update the alignment function to accept big campaign
-        for campaign in self.campaigns:
-            print("start analyzing this report "+campaign.id)
-            if self.multiprocessing:
-                #multi process verion
-                Alignment.all_alignment_multiprocess(campaign,self.procedures, self.techniques)
-            else:
-                #single process version  
-                Alignment.all_alignment_sequential(campaign,self.procedures, self.techniques)
+        # one pool for every report, its workers keep the procedures, techniques and campaign chunks
+        executor = alignment_pool(self.procedures, self.techniques, campaign_chunks(self.campaigns)) if self.multiprocessing else None
+        try:
+            for campaign in self.campaigns:
+                print("start analyzing this report "+campaign.id)
+                if self.multiprocessing:
+                    #multi process verion
+                    Alignment.all_alignment_multiprocess(campaign,self.procedures, self.techniques, executor)
+                else:
+                    #single process version  
+                    Alignment.all_alignment_sequential(campaign,self.procedures, self.techniques)
                 
-            # print(f"Sequence techniques for {campaign.id} is :\n ", sequence_techniques)
-            # campaign.sequence_techniques = sequence_techniques
+                # print(f"Sequence techniques for {campaign.id} is :\n ", sequence_techniques)
+                # campaign.sequence_techniques = sequence_techniques
             
-            # with open(os.path.join(campaigns_sequence_techniques, campaign.id + ".json"), "w") as f:
-            #     json.dump(sequence_techniques, f, indent=4)
-            mapper_ = campaign.mapper
-            file_path = os.path.join(campaigns_procedure_alignment_dir, campaign.id + ".pkl")
+                # with open(os.path.join(campaigns_sequence_techniques, campaign.id + ".json"), "w") as f:
+                #     json.dump(sequence_techniques, f, indent=4)
+                mapper_ = campaign.mapper
+                file_path = os.path.join(campaigns_procedure_alignment_dir, campaign.id + ".pkl")
             
-            with open(file_path, 'wb') as handle:
-                pickle.dump(mapper_, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                with open(file_path, 'wb') as handle:
+                    pickle.dump(mapper_, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            if executor is not None:
+                executor.shutdown()
         print("done")
     def big_procedure_matching(self):
                  #todo: flatten the big campaign or update the alignment function to accept big campaign
-        for campaign in self.big_campaigns:
-            print("start analyzing this report "+campaign.id)
-            if self.multiprocessing:
-                #multi process verion
-                Alignment.all_alignment_big_campaign_multiprocess(campaign,self.procedures, self.techniques)
-            else:
-                #single process version  
-                Alignment.all_alignment_sequential_big_campaign_sequential(campaign,self.procedures, self.techniques)
+        run_stats = dict()
+        cross_report = self.multiprocessing and Keys.ALIGNMENT_CROSS_REPORT
+        if cross_report:
+            # every report at once, procedure by procedure, from the one store of all the reports
+            bert_sim_path = os.path.join(campaigns_bert, "all.npy")
+            if not self.shared_bert_object_covers(bert_sim_path):
+                # MULTI_PROCESSING only builds the per-report stores, or all.npy was built for other reports
+                print("all.npy is missing or does not cover the loaded reports, building it for the cross-report alignment")
+                self.generate_shared_bert_object(bert_sim_path)
+            Alignment.all_alignment_cross_report_multiprocess(self.big_campaigns, self.procedures, self.techniques, bert_sim_path)
+        # one pool for every report, its workers keep the procedures, techniques and campaign chunks
+        executor = alignment_pool(self.procedures, self.techniques, campaign_chunks(self.big_campaigns)) if self.multiprocessing and not cross_report else None
+        try:
+            for campaign in self.big_campaigns:
+                print("start analyzing this report "+campaign.id)
+                if cross_report:
+                    pass # aligned above with the other reports
+                elif self.multiprocessing:
+                    #multi process verion
+                    Alignment.all_alignment_big_campaign_multiprocess(campaign,self.procedures, self.techniques, executor)
+                else:
+                    #single process version  
+                    Alignment.all_alignment_sequential_big_campaign_sequential(campaign,self.procedures, self.techniques)
             
-            # print(f"Sequence techniques for {campaign.id} is :\n ", sequence_techniques)
-            # campaign.sequence_techniques = sequence_techniques
+                # print(f"Sequence techniques for {campaign.id} is :\n ", sequence_techniques)
+                # campaign.sequence_techniques = sequence_techniques
             
-            # with open(os.path.join(campaigns_sequence_techniques, campaign.id + ".json"), "w") as f:
-            #     json.dump(sequence_techniques, f, indent=4)
-            if campaign.mapper is None:
-                campaign.mapper_gathering()
-            mapper_ = campaign.mapper
-            file_path = os.path.join(campaigns_procedure_alignment_dir, campaign.id + ".json")
-            with open(file_path, "w") as f:
-                json.dump(mapper_, f, indent=4)
-            # with open(file_path, 'wb') as handle:
-            #     pickle.dump(mapper_, handle, protocol=pickle.HIGHEST_PROTOCOL)
-            # with open(file_path, 'rb') as handle:
-            #     mapper_2 = pickle.load(handle)
-            # print(mapper_2 == mapper_)    
+                # with open(os.path.join(campaigns_sequence_techniques, campaign.id + ".json"), "w") as f:
+                #     json.dump(sequence_techniques, f, indent=4)
+                if campaign.mapper is None:
+                    campaign.mapper_gathering()
+                mapper_ = campaign.mapper
+                file_path = os.path.join(campaigns_procedure_alignment_dir, campaign.id + ".json")
+                with open(file_path, "w") as f:
+                    json.dump(mapper_, f, indent=4)
+                run_stats[campaign.id] = dict(getattr(campaign, "search_stats", dict()))
+                # procedures skipped by the label prefilter in each chunk, to check its recall
+                run_stats[campaign.id]["skipped_per_chunk"] = getattr(campaign, "skipped_per_chunk", [])
+                # seconds each worker spent on the tasks of this report
+                run_stats[campaign.id]["worker_busy"] = getattr(campaign, "worker_busy", dict())
+                # with open(file_path, 'wb') as handle:
+                #     pickle.dump(mapper_, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                # with open(file_path, 'rb') as handle:
+                #     mapper_2 = pickle.load(handle)
+                # print(mapper_2 == mapper_)    
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        #prefilter and combination search counters of graph_alignment, per report
+        with open(campaigns_run_stats_file + ".tmp", "w") as f:
+            json.dump(run_stats, f, indent=4)
+        os.replace(campaigns_run_stats_file + ".tmp", campaigns_run_stats_file)
         print("done")
 
     def report_decoding(self,matching_result_dir:str = campaigns_procedure_alignment_dir, tech_alignment_dir:str = campaigns_tech_alignment_dir, saved_decoding_dir:str = campaigns_decoding_result):
@@ -671,6 +785,9 @@ class Manager():
                     continue
                 if procedure.id not in marking_dict or marking_dict[procedure.id]:
                     procedure.to_json(os.path.join(saved_dir, procedure.id + ".json"),reverse_text=False)
+        # the pairs above all share the store of alignment_multiprocessing
+        if alignment_multiprocessing.bert_similarity is not None:
+            alignment_multiprocessing.bert_similarity.cache_report()
 
     
     def procedure_accumulation(self,procedure_id1, procedure_id2, combination):
@@ -736,6 +853,8 @@ class Manager():
             else:
                 verbs.append(verb2)
             v["verbs"] = list(set(verbs))
+        # procedure1 is compared again with the next procedures, from its new labels, texts and verbs
+        procedure1.clear_indexes()
         return True
     
     def procedure_similarity(self, procedure_id1, procedure_id2):
@@ -0,0 +1,76 @@
+import weakref
+import zlib
+import numpy as np
+from keys import Keys
+from modules import malwares
+
+
+def label_bit(label: str):
+    """ bit of a node label in the label masks, following Keys.LABEL2ID
+    """
+    label_id = Keys.LABEL2ID.get(label)
+    if label_id is None or label_id < 0:
+        # ABSTAIN and labels outside LABEL2ID, same bit in every process
+        label_id = len(Keys.ID2LABEL) + zlib.crc32(label.encode()) % (62 - len(Keys.ID2LABEL))
+    return 1 << label_id
+
+
+def label_mask(labels: list):
+    mask = 0
+    for label in labels:
+        mask |= label_bit(label)
+    return mask
+
+
+class NodeIndex():
+    """ what Alignment._node_similarity_calculation reads from the nodes of a paragraph (campaign chunk or procedure),
+        resolved once into arrays following the order of paragraph.graph_nodes
+        masks[i]: labels of node i as a bitmask over Keys.LABEL2ID
+        single[i]: Keys.LABEL2ID of the label when node i has exactly one, -1 otherwise
+        pronoun[i]: the text of node i is "it" or "they"
+        gated[i]: node i only matches the nodes sharing one of its labels (single VULNERABILITY, USER or ACTOR but "it"/"they")
+        malware[i]: one of the true texts of node i is a known malware
+        texts[i]: true texts of node i, the phrases looked up in the similarity store
+    """
+    def __init__(self, paragraph):
+        self.node_ids = list(paragraph.graph_nodes.keys())
+        self.position = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        metas = [paragraph.graph_nodes[node_id]["meta"] for node_id in self.node_ids]
+        self.masks = np.array([label_mask(meta["label"]) for meta in metas], dtype=np.int64)
+        self.single = np.array([Keys.LABEL2ID.get(meta["label"][0], -1) if len(meta["label"]) == 1 else -1 for meta in metas], dtype=np.int64)
+        self.pronoun = np.array([meta["text"].lower() in ["it","they"] for meta in metas], dtype=bool)
+        self.gated = self.is_single("VULNERABILITY") | self.is_single("USER") | (self.is_single("ACTOR") & ~self.pronoun)
+        self.texts = list()
+        for meta in metas:
+            if "texts" in meta:
+                self.texts.append(paragraph.get_true_text(texts = meta["texts"]))
+            else:
+                self.texts.append([paragraph.get_true_text(text = meta["text"])])
+        self.malware = np.array([len(set(texts).intersection(malwares)) > 0 for texts in self.texts], dtype=bool)
+        self._resolved = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __getstate__(self):
+        # the resolved phrase indices belong to one similarity store of this process
+        state = self.__dict__.copy()
+        state["_resolved"] = None
+        return state
+
+    def positions(self, node_ids: list):
+        return np.array([self.position[node_id] for node_id in node_ids], dtype=np.int64)
+
+    def is_single(self, label: str):
+        return self.single == Keys.LABEL2ID[label]
+
+    def phrase_indices(self, similarity):
+        """ similarity.indices of the true texts of every node, kept until the store or its phrases change
+        """
+        if self._resolved is not None:
+            store, n_rows, n_cols, indices = self._resolved
+            if store() is similarity and n_rows == len(similarity.rows) and n_cols == len(similarity.cols):
+                return indices
+        indices = [similarity.indices(texts) for texts in self.texts]
+        self._resolved = (weakref.ref(similarity), len(similarity.rows), len(similarity.cols), indices)
+        return indices
@@ -1,12 +1,13 @@
 from classes.sentence import Sentence
 from language_models import nlp
 from modules import common_fixing_pattern
-from classes.preprocessings import text_preprocessing
+from classes.preprocessings import text_preprocessing, text_preprocessing_pipe
 from classes.heuristic_model import heuristic_extract_, replace_special_entities
 import pandas as pd
 import re
 import os
 import json
+import hashlib
 from networkx import DiGraph
 import math
 import networkx as nx
@@ -29,24 +30,29 @@ class Paragraph:
 
             # self.draw()
 
-    def data_generation(self, is_campaign = True):
+    def data_generation(self, is_campaign = True, prepared = None):
+            # prepared: (text, replacement_mapper, doc, sentence docs) of Paragraph.prepare_pipe, the text is preprocessed and parsed here when None
             self.is_campaign = is_campaign
-            self.preprocessing(flag = is_campaign)
-            self.text, self.replacement_mapper = self.replace_special_entity()
-
-
-            self.doc = nlp(self.text)
+            sentence_docs = None
+            if prepared is None:
+                self.preprocessing(flag = is_campaign)
+                self.text, self.replacement_mapper = self.replace_special_entity()
+                self.doc = nlp(self.text)
+            else:
+                self.text, self.replacement_mapper, self.doc, sentence_docs = prepared
             self.backup_sents = list(self.doc.sents)
             self.graph_nodes = dict()
             self.graph_edges = dict()
             # the spacy doc of the paragraph
             sents = list(self.doc.sents)
+            if sentence_docs is None:
+                sentence_docs = Paragraph.parse_sentences(sents)
             self.sentences = list()
             for i in range(0,len(sents)):
                 sent = sents[i]
                 if "where" in sent.text or "when" in sent.text or "how" in sent.text or "why" in sent.text or "what" in sent.text or "who" in sent.text or "which" in sent.text:
                     print("debug")
-                _sent = Sentence(sent.text, i, self.replacement_mapper)
+                _sent = Sentence(sent.text, i, self.replacement_mapper, span = sent, doc = sentence_docs[i])
                 self.sentences.append(_sent)
             if is_campaign: #this is a campaign
                 # self.coreferee_resolution()
@@ -129,6 +135,31 @@ class Paragraph:
         # # self.simplify_graph1()
         # self.generate_edge_dict()
         # self.regenerate_graph_nodes()
+    @classmethod
+    def parse_sentences(cls, sents: list, batch_size = Keys.SENTENCE_PIPE_BATCH_SIZE, n_process = 1):
+        """ the parse of every sentence of sents on its own, as Sentence would make it, with nlp.pipe
+            None for every sentence when Sentence reads its span of the paragraph parse instead (REUSE_SENTENCE_SPANS)
+        """
+        if Keys.REUSE_SENTENCE_SPANS:
+            return [None] * len(sents)
+        return list(nlp.pipe([sent.text for sent in sents], batch_size = batch_size, n_process = n_process))
+
+    @classmethod
+    def prepare_pipe(cls, texts:list, is_campaign = True, batch_size = 64, n_process = 1):
+        """ the preprocessing, replace_special_entity and parse of data_generation for every text of texts,
+            with the texts and their sentences parsed by nlp.pipe in batches of batch_size
+            return the (text, replacement_mapper, doc, sentence docs) to pass to data_generation, in the order of texts
+        """
+        prepared = []
+        for text in text_preprocessing_pipe(texts, flag = is_campaign, batch_size = batch_size, n_process = n_process):
+            paragraph = Paragraph(text)
+            prepared.append(paragraph.replace_special_entity())
+        docs = list(nlp.pipe([text for text, replacement_mapper in prepared], batch_size = batch_size, n_process = n_process))
+        # the sentences of all the texts, parsed on their own in one nlp.pipe call as well
+        sents = [list(doc.sents) for doc in docs]
+        sentence_docs = iter(Paragraph.parse_sentences([sent for doc_sents in sents for sent in doc_sents], batch_size = batch_size, n_process = n_process))
+        return [(text, replacement_mapper, doc, [next(sentence_docs) for _ in doc_sents]) for (text, replacement_mapper), doc, doc_sents in zip(prepared, docs, sents)]
+
     def preprocessing(self, flag = True):
         # char_remove = "\n|\t|\r"
         # self.text = re.sub(char_remove, " ", self.text).replace("  ", " ")
@@ -668,6 +699,52 @@ class Paragraph:
                 phrases.extend(_phrase)
         self.phrases = list(set(phrases))
 
+    def get_phrase_nodes(self):
+        """ phrase -> list of node meta that use this phrase, the phrases are the same as get_phrases
+        """
+        phrase_nodes = dict()
+        for node in self.graph_nodes.values():
+            node = node["meta"]
+            if "texts" in node:
+                _phrase = self.get_true_text(texts = node["texts"])
+            else:
+                _phrase = [self.get_true_text(text = node["text"])]
+            for phrase in _phrase:
+                phrase_nodes.setdefault(phrase, []).append(node)
+        return phrase_nodes
+
+    def canonical_graph(self):
+        """ what the alignment reads from the graph, nodes and edges kept in their order (the combination search follows it):
+            sorted labels, "it"/"they" text, resolved texts and verbs of each node, then the ends, verb and verbs of each edge
+        """
+        position = {k: i for i, k in enumerate(self.graph_nodes.keys())}
+        nodes = []
+        for node in self.graph_nodes.values():
+            node = node["meta"]
+            if "texts" in node:
+                _phrase = self.get_true_text(texts = node["texts"])
+            else:
+                _phrase = [self.get_true_text(text = node["text"])]
+            verbs = tuple(sorted(set(node["verbs"]))) if "verbs" in node else None
+            nodes.append((tuple(sorted(node["label"])), node["text"].lower() in ["it", "they"], tuple(sorted(set(_phrase))), verbs))
+        edges = []
+        for edge in self.graph_edges.values():
+            verbs = tuple(sorted(set(edge["verbs"]))) if "verbs" in edge else None
+            edges.append((position.get(edge["source"], -1), position.get(edge["dest"], -1), edge.get("verb"), verbs))
+        return tuple(nodes), tuple(edges)
+
+    def get_graph_hash(self):
+        """ paragraphs with the same hash get the same graph_alignment in a campaign, up to their node ids
+        """
+        return hashlib.sha1(repr(self.canonical_graph()).encode()).hexdigest()
+
+
+    def clear_indexes(self):
+        """ drop the alignment indexes built from the nodes (node_index, campaign_index, graph_hash)
+            after the labels, texts or verbs of the nodes change, they are rebuilt on next use
+        """
+        for name in ["node_index", "campaign_index", "graph_hash"]:
+            self.__dict__.pop(name, None)
 
     def simplify_graph2(self):
         # if len(self.graph_nodes) <= 3:
@@ -261,8 +261,8 @@ def coref_resolution(text):
     for sent in sents:
         new_texts.append(coref_text(sent.text))
     return " ".join(new_texts)
-def subject_elipsis(text:str):
-    doc = nlp(text)
+def subject_elipsis(text:str, _doc = None):
+    doc = nlp(text) if _doc is None else _doc
 
     sents = list(doc.sents)
     if len(sents) == 0:
@@ -299,14 +299,19 @@ functions_dict ={
 
 }
 
-def text_preprocessing(txt, paragraph_functions= ['fix_unicode',"handling_substitutions",  "CـC", "homogenization", 'ellipsis_subject'], flag = True):
+def paragraph_cleaning(txt, flag = True):
+    """ the steps of text_preprocessing before the text is split into sentences
+    """
     txt = fix_enumeration(txt)
     mitre_specific = ['remove_link_and_citations','remove_explicit_entity']
     for func in mitre_specific:
         txt = functions_dict[func](txt)
     if flag:
         txt = coref_resolution(txt)
+    return txt
 
+def text_preprocessing(txt, paragraph_functions= ['fix_unicode',"handling_substitutions",  "CـC", "homogenization", 'ellipsis_subject'], flag = True):
+    txt = paragraph_cleaning(txt, flag = flag)
     
     new_txt = ""
 
@@ -317,6 +322,31 @@ def text_preprocessing(txt, paragraph_functions= ['fix_unicode',"handling_substi
         new_txt += new_sent_text + " "
     return new_txt.replace("  ", " ").strip()
 
+def text_preprocessing_pipe(txts:list, paragraph_functions= ['fix_unicode',"handling_substitutions",  "CـC", "homogenization", 'ellipsis_subject'], flag = True, batch_size = 64, n_process = 1):
+    """ text_preprocessing of every text of txts, with the texts and then their sentences parsed by nlp.pipe in batches
+        the parses only serve the sentence splitting and ellipsis_subject, so coreferee is left out of them
+    """
+    disable = [name for name in ["coreferee"] if name in nlp.pipe_names]
+    txts = [paragraph_cleaning(txt, flag = flag) for txt in txts]
+    sentences = [[sent.text for sent in doc.sents] for doc in nlp.pipe(txts, batch_size = batch_size, n_process = n_process, disable = disable)]
+    sents = [sent for text_sentences in sentences for sent in text_sentences]
+    # every function of sentence_processing works on one sentence, so they can be applied function by function
+    for func in paragraph_functions:
+        if func == "ellipsis_subject":
+            docs = nlp.pipe(sents, batch_size = batch_size, n_process = n_process, disable = disable)
+            sents = [subject_elipsis(sent, _doc = doc) for sent, doc in zip(sents, docs)]
+        else:
+            sents = [functions_dict[func](sent) for sent in sents]
+    new_txts = []
+    start = 0
+    for text_sentences in sentences:
+        new_txt = ""
+        for new_sent_text in sents[start:start + len(text_sentences)]:
+            new_txt += new_sent_text + " "
+        new_txts.append(new_txt.replace("  ", " ").strip())
+        start += len(text_sentences)
+    return new_txts
+
 def sentence_processing(sent,exhaustive=False, paragraph_functions= ['fix_unicode',"handling_substitutions",  "CـC", "homogenization",'ellipsis_subject'], flag = True):
     # if not flag:
     #     sent = remove_before_after(sent)
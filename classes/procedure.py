@@ -6,19 +6,24 @@ from keys import *
 import statistics
 
 
+def fix_subject(text:str):
+    if text.startswith("can"): # fix some special cases lacking of subject
+        text = "It " + text
+    return text
+
+
 class Procedure(Paragraph):
-    def __init__(self, text:str= "", tech_id:str = "", procedure_id = "", locations:list = [], special_id = "", image_path = ""):
+    def __init__(self, text:str= "", tech_id:str = "", procedure_id = "", locations:list = [], special_id = "", image_path = "", prepared = None):
 
         if text != "":
             self.id = procedure_id
             self.tech_id = tech_id
             self.locations = locations
-            if text.startswith("can"): # fix some special cases lacking of subject
-                 text = "It " + text
+            text = fix_subject(text)
             self.text = text
             self.special_id = special_id
             super().__init__(self.text)
-            super().data_generation(is_campaign = False)
+            super().data_generation(is_campaign = False, prepared = prepared)
             
             if image_path != "":
                 super().rescontruct_graph()
@@ -43,12 +48,37 @@ class Procedure(Paragraph):
         return none_entity_nodes
 
 
-    def to_json(self, path: str, reverse_text = True):
+    @classmethod
+    def pipe(cls, rows:list, batch_size = 64, n_process = 1):
+        """ the Procedure of every row of rows (keyword arguments of Procedure), built as Procedure(**row)
+            but with the texts and their sentences parsed by nlp.pipe in batches of batch_size
+            yield (row, procedure, error), procedure is None and error the exception when the row could not be built
+        """
+        try:
+            texts = [fix_subject(row["text"]) for row in rows]
+            prepared = Paragraph.prepare_pipe(texts, is_campaign = False, batch_size = batch_size, n_process = n_process)
+        except Exception as error:
+            # one text breaks the batch, the rows are built one by one so that only this one fails
+            print(f"batched parse failed ({error!r}), building these {len(rows)} procedures one by one")
+            prepared = [None] * len(rows)
+        for row, _prepared in zip(rows, prepared):
+            try:
+                procedure = cls(**row, prepared = _prepared)
+            except Exception as error:
+                yield row, None, error
+                continue
+            yield row, procedure, None
+
+    def to_dict(self, reverse_text = True):
         data = super().to_dict(reverse_text)
         data["id"] = self.id
         data["tech_id"] = self.tech_id
         data["location"] = self.locations
         data["special_id"] = self.special_id
+        return data
+
+    def to_json(self, path: str, reverse_text = True):
+        data = self.to_dict(reverse_text)
         with open(path, "w") as f:
             json.dump(data, f, indent=4)
 
@@ -61,6 +91,7 @@ class Procedure(Paragraph):
             self.special_id = data["special_id"]
             super().from_dict(data)
             super().get_phrases()
+            self.graph_hash = self.get_graph_hash()
         else:
             with open(path, "r") as f:
                 data = json.load(f)
@@ -70,6 +101,7 @@ class Procedure(Paragraph):
                 self.special_id = data["special_id"]
                 super().from_dict(data)
                 super().get_phrases()
+                self.graph_hash = self.get_graph_hash()
 
    
  
@@ -17,12 +17,15 @@ def delete_ENTITY(text):
     entity_pattern = r"\b(ENTITY)[0-9]+\b"
     return re.sub(entity_pattern, "", text).strip()
 class Sentence:
-    def __init__(self, sent = "", sent_id= "", replacement:dict=None):
+    def __init__(self, sent = "", sent_id= "", replacement:dict=None, span = None, doc = None):
         self.id = sent_id # order number of the sentence in the paragrah
         self.text = sent # the text of the sentence
         if self.text != "":
             self.replacement_mapper = replacement         
-            self.doc, self.svos, self.chains =  action_extraction_per_sentence(sentence= sent) #list of tripple S-V-O (subject-verb-object)
+            # span: the sentence in the paragraph parse, as_doc() keeps its annotations with token ids and offsets starting from this sentence
+            # doc: the parse of sent on its own, made by nlp.pipe with the other sentences (Paragraph.parse_sentences), sent is parsed here when None
+            _doc = span.as_doc() if span is not None and Keys.REUSE_SENTENCE_SPANS else doc
+            self.doc, self.svos, self.chains =  action_extraction_per_sentence(sentence= sent, _doc = _doc) #list of tripple S-V-O (subject-verb-object)
             # self.example_cases = get_examples_cases(self.doc)
 
             self._extract_entities() # list of entities in the sentence
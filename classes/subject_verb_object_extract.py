@@ -1,5 +1,6 @@
 
 from language_models import nlp
+from classes.lexical_cache import get_lemma, synthetic_token
 import itertools
 from modules import remove_words
 # dependency markers for subjects
@@ -238,10 +239,7 @@ def _get_that_resolution(toks):
 
 # simple stemmer using lemmas
 def _get_lemma(word):
-    tokens = nlp(word)
-    if len(tokens) == 1:
-        return tokens[0].lemma_
-    return word
+    return get_lemma(word)
 
 def _expand_verb(verb):
     if not hasattr(verb, 'rights'):
@@ -631,7 +629,7 @@ def via_handling(verb, tokens):
     else:
             subs, verbNegated = _get_all_subs(verb)
     if len(subs) == 0:
-        _sub = nlp("Attacker")[0]
+        _sub = synthetic_token("Attacker")
         subs= [_sub]
     children = list(verb.children)
     svos = []
@@ -665,7 +663,7 @@ def via_handling(verb, tokens):
                         objs = _get_conj_noun(item)
                         if len(objs) == 0:
                             objs = [item]
-                        _verb = nlp("use")[0]
+                        _verb = synthetic_token("use")
                         # verbNegated = _is_negated(_verb)
                         verbs= [_verb]
                         is_pas = False
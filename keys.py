@@ -4,17 +4,47 @@ class Keys():
     LAMDA = 0.4 # put more focus on the label
     SOFT_LAMDA = 0.3 # put more focus on the text
     NODE_SIMILARITY_THRESHOLD = 0.8
+    NODE_SIMILARITY_BOOST = 0.2 # scale up USER/VULNERABILITY/REGISTRY pairs
     MATCHING_THRESHOLD = 0.8
+    ALIGNMENT_MAX_COMBINATIONS = 20000 # evaluated (not pruned) combinations per procedure in graph_alignment
+    ALIGNMENT_BATCH_SIZE = 4096 # combinations scored together as arrays in graph_alignment, 0 scores them one by one
+    ALIGNMENT_PREFILTER = True # skip the procedures whose labels cannot reach MATCHING_THRESHOLD in a campaign chunk
+    ALIGNMENT_CLUSTERS = False # align one procedure per cluster of similar procedures, the others only where it was located
+    ALIGNMENT_CROSS_REPORT = False # align the chunks of all loaded reports in one pass over the procedures, needs one similarity store for all of them
     DECODING_RECODE  = True
     DECODING_MATCHING_THRESHOLD = 0.87
     DECODING_RELAXING = True
     STRONG_VERB_GROUP = ["delete","mimic","schedule","reboot","hide","prevent","encode compress","decode","exfiltrate","command","reboot","user_action","proxy","damge","search analyze","install develop","change"]
     DECODING_CRITERIA = "heuristic"
     DISTANCE_FACTOR_PER_SENTENCE = 0.3
+    REUSE_SENTENCE_SPANS = False # Sentence reads its span of the paragraph parse instead of parsing the sentence on its own, turn on only once utils.sentence_parse_regression reports no differing chunk
+    SENTENCE_PIPE_BATCH_SIZE = 64 # sentences per nlp.pipe batch when the sentences of a paragraph are parsed on their own
+    PROCEDURE_PIPE = False # build the procedures with nlp.pipe and write them straight to the jsonl store (Manager.analyze_procedures_from_text_pipe)
+    PROCEDURE_PIPE_BATCH_SIZE = 64 # texts per nlp.pipe batch
+    PROCEDURE_PIPE_PROCESSES = 1 # n_process of nlp.pipe, keep 1 when the model runs on GPU
+    PROCEDURE_PIPE_CHUNK_SIZE = 1024 # procedures parsed together, their graphs are built and written before the next chunk is parsed
+    LEXICAL_MODEL = "en_core_web_lg" # tagger and lemmatizer of the lemma/POS lookups of classes/lexical_cache.py, "" uses the transformer pipeline
+    LEXICAL_CACHE_SIZE = 65536 # words and phrases whose lemma/POS lookups are kept
     CAMPAIGN_PATH = r"data/campaign"
     PROCEDURE_PATH = r"data/procedure"
     TECHNIQUE_PATH = r"data/Techniques"
     CONTEXT_SIMILARITY_PATH = r"data/campaign/USE_cosine"
+    SIMILARITY_DTYPE = "float32" # "float16" halves the size of the similarity matrix, "int8" quarters it
+    SIMILARITY_SPARSE = False # only keep phrase pairs that can pass NODE_SIMILARITY_THRESHOLD
+    SIMILARITY_LABEL_PARTITION = True # skip phrase pairs whose node labels make alignment return 0 without the text
+    USE_MODEL_URL = "https://tfhub.dev/google/universal-sentence-encoder-large/5"
+    USE_MODEL_DIR = None # local directory of the saved model, default is the TFHUB_CACHE_DIR entry of USE_MODEL_URL
+    TFHUB_CACHE_DIR = r"./data/tf_hub"
+    EMBEDDING_CACHE_ENABLE = True
+    EMBEDDING_CACHE_PATH = r"data/campaign/USE_cosine/embeddings"
+    EMBEDDING_DTYPE = "float32" # "float16", or "int8" with one scale per vector
+    EMBEDDING_BATCH_SIZE = 256
+    EMBEDDING_SERVER_ADDRESS = None # e.g. ("localhost", 6010), when set the phrases are embedded by classes/embedding_server.py
+    EMBEDDING_SERVER_AUTHKEY = b"raf-ag-embedding"
+    EMBEDDING_SERVER_BATCH_SIZE = 1024 # phrases per micro-batch
+    EMBEDDING_SERVER_WAIT = 0.02 # seconds to wait for more requests before encoding a micro-batch
+    SIMILARITY_BLOCK_SIZE = 4096 # reference phrases per block when computing the similarity matrix
+    SIMILARITY_MEMORY_LIMIT_MB = 1024 # memory ceiling of one block, the block size is reduced to stay under it
     FIXING_PATTERN = r"data/patterns/fix_pattern.json"
     TOP_VALUE = 1
     DECODING_TOP_K = 1
@@ -31,6 +61,7 @@ class Keys():
     #reduce by half
     NUM_PROCESSES = math.floor(psutil.cpu_count(logical=False)/2)
     NUM_WORK_PER_PROCESS = 1000
+    ALIGNMENT_TASKS_PER_PROCESS = 4 # tasks of about the same estimated cost queued per process and campaign chunk, 0 slices NUM_WORK_PER_PROCESS procedures
     BERT_SIM_ENABLE = True
     MULTI_PROCESSING = False
     ACTOR_TOLERATE_DISTANCE = 1.0
@@ -27,53 +27,49 @@ with open(r"data/meta data/verb_similarity.json", "r") as f:
     verb_similarity = verb_data["group"]
     imporant_verbs = verb_data["important"]
 
+# verb -> bitmask of the verb_similarity groups it belongs to, bit i for the i-th group
+# so that the verb checks are AND/XOR of integers instead of set intersections over every group
+verb_group_bit = {k: 1 << i for i, k in enumerate(verb_similarity.keys())}
+verb_groups = dict()
+for k,v in verb_similarity.items():
+    for verb in v:
+        verb_groups[verb] = verb_groups.get(verb, 0) | verb_group_bit[k]
+def verb_group_mask(groups):
+    mask = 0
+    for k in groups:
+        mask |= verb_group_bit.get(k, 0)
+    return mask
+strong_verb_mask = verb_group_mask(Keys.STRONG_VERB_GROUP)
+def verbs_mask(verbs):
+    mask = 0
+    for verb in verbs:
+        mask |= verb_groups.get(verb, 0)
+    return mask
 def check_if_verb_is_strong(verbs, strong_verb_group = Keys.STRONG_VERB_GROUP):
-    for k,v in verb_similarity.items():
-        if k not in strong_verb_group:
-            continue
-        set_v = set(v)
-        set_v1 = set(verbs)
-        lists1 = list(set_v1.intersection(set_v ))
-        if len(lists1) > 0:
-            return True
-    return False
+    strong_mask = strong_verb_mask if strong_verb_group is Keys.STRONG_VERB_GROUP else verb_group_mask(strong_verb_group)
+    return (verbs_mask(verbs) & strong_mask) != 0
 def check_strong_verb_similarity_mismatch(verbs1, verbs2, strong_verb_group = Keys.STRONG_VERB_GROUP):
     if len(verbs1) == 0 or len(verbs2) == 0:
         return False
-    set_v1 = set(verbs1)
-    set_v2 = set(verbs2)
-    for k,v in verb_similarity.items():
-        if k not in strong_verb_group:
-            continue
-        set_v = set(v)
-        lists1 = list(set_v1.intersection(set_v ))
-        lists2 = list(set_v2.intersection(set_v ))
-        if len(lists1) > 0 and len(lists2) == 0:
-            return True # this is the key, verb is very strong and it is not in the second list
-        if len(lists2) > 0 and len(lists1) == 0:
-            return True
-    return False
-def check_verbs_similarity(verbs1:list, verbs2:list):
+    strong_mask = strong_verb_mask if strong_verb_group is Keys.STRONG_VERB_GROUP else verb_group_mask(strong_verb_group)
+    # a strong group in one list but not in the other
+    return ((verbs_mask(verbs1) ^ verbs_mask(verbs2)) & strong_mask) != 0
+def check_verbs_similarity(verbs1:list, verbs2:list, mask1:int = None, mask2:int = None):
+    """ mask1, mask2: verbs_mask of verbs1 and verbs2 when they are already known
+    """
     if len(verbs1) == 0 or len(verbs2) == 0:
         return False
-    set_v1 = set(verbs1)
-    set_v2 = set(verbs2)
-    if len(set_v1.intersection(set_v2)) > 0:
+    if not set(verbs1).isdisjoint(verbs2):
         return True
-    for k,v in verb_similarity.items():
-        set_v = set(v)
-        lists1 = list(set_v1.intersection(set_v ))
-        lists2 = list(set_v2.intersection(set_v ))
-        if len(lists1) > 0 and len(lists2) > 0:
-            return True
-    return False
+    if mask1 is None:
+        mask1 = verbs_mask(verbs1)
+    if mask2 is None:
+        mask2 = verbs_mask(verbs2)
+    return (mask1 & mask2) != 0
 def check_verb_similarity(verb1, verb2):
     if verb1 == verb2:
         return True
-    for k,v in verb_similarity.items():
-         if verb1 in v and verb2 in v:
-             return True
-    return False
+    return (verb_groups.get(verb1, 0) & verb_groups.get(verb2, 0)) != 0
 heuristic_tactic_combinations = []
 for c in tactic_combinations:
     source = c["first"]["id"]
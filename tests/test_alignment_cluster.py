@@ -0,0 +1,46 @@
+import types
+import pytest
+from keys import Keys
+from classes import alignment_multiprocessing
+from classes.alignment_multiprocessing import alignment_cluster
+
+# campaign node -> sent_index
+SENT_INDEXES = {10: 0, 11: 1, 12: 2, 13: 3}
+LOCATED = {0: [{"id": "representative", "sent_indexes": [1, 2]}]}
+
+
+def fake_alignment(results: dict, calls: list):
+    """ alignment_ returning results[procedure id] = (graph_alignment score or None when the graph is not aligned, rs)
+    """
+    def alignment_(campaign, procedure, technique, sub_graph = None, alignments = None):
+        calls.append((procedure.id, sub_graph))
+        value, rs = results[procedure.id]
+        if alignments is not None and value is not None:
+            procedure.graph_hash = procedure.id
+            alignments[procedure.graph_hash] = (value, None)
+        return rs
+    return alignment_
+
+
+@pytest.mark.parametrize("representative, expected", [
+    # no edges: alignment_ returns before graph_alignment, the member is aligned with the whole campaign
+    ((None, None), [("representative", None), ("member", None)]),
+    # only ACTOR and USER located: rejected after a score above MATCHING_THRESHOLD, same
+    ((0.9, None), [("representative", None), ("member", None)]),
+    # aligned but not located
+    ((0.9, {}), [("representative", None), ("member", None)]),
+    # scored below MATCHING_THRESHOLD: the member is skipped
+    ((0.5, {}), [("representative", None)]),
+    # located: the member is aligned where the representative is
+    ((0.9, LOCATED), [("representative", None), ("member", [11, 12])]),
+])
+def test_alignment_cluster_members(monkeypatch, representative, expected):
+    monkeypatch.setattr(Keys, "MATCHING_THRESHOLD", 0.8)
+    calls = []
+    results = {"representative": representative, "member": (0.9, {})}
+    monkeypatch.setattr(alignment_multiprocessing, "alignment_", fake_alignment(results, calls))
+    campaign = types.SimpleNamespace(campaign_index = types.SimpleNamespace(sent_indexes = SENT_INDEXES))
+    cluster = [types.SimpleNamespace(id = "representative", special_id = "T1"), types.SimpleNamespace(id = "member", special_id = "T1")]
+    rs = dict()
+    alignment_cluster(campaign, cluster, {"T1": None}, dict(), rs)
+    assert calls == expected
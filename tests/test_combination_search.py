@@ -0,0 +1,137 @@
+import itertools
+import random
+import networkx as nx
+import pytest
+from keys import Keys
+from modules import verb_similarity
+from classes.campaign import Campaign
+from classes.procedure import Procedure
+from classes.campaign_index import CampaignIndex
+from classes.alignment_multiprocessing import Alignment
+
+LABELS = [["ACTOR"], ["OTHER"], ["FUNCTION"], ["DATA"], ["VULNERABILITY"], ["REGISTRY"], ["USER"], ["FUNCTION", "DATA"], ["ACTOR", "FUNCTION"]]
+SIMILARITIES = [0.8, 0.85, 0.9, 1.0] # few values so that many combinations tie
+VERBS = [group[0] for group in list(verb_similarity.values())[:4]] + ["delete", "unknownverb"]
+
+
+def synthetic_campaign(rng: random.Random, n_nodes: int):
+    """ a campaign chunk of n_nodes nodes over a few sentences, with a random graph (some nodes unreachable)
+    """
+    campaign = Campaign()
+    campaign.id = "synthetic"
+    campaign.replacement_mapper = dict()
+    campaign.graph_nodes = dict()
+    for i in range(n_nodes):
+        node_id = rng.randrange(4) * 1000 + i * 7
+        meta = {"label": rng.choice(LABELS), "text": f"phrase {i}", "type": rng.choice(["object", "subject"])}
+        if meta["type"] == "object" and rng.random() < 0.7:
+            meta["verbs"] = rng.sample(VERBS, rng.randint(1, 2))
+        if rng.random() < 0.3:
+            meta["ids"] = [node_id, rng.randrange(4) * 1000 + rng.randrange(40)]
+        campaign.graph_nodes[node_id] = {"id": node_id, "meta": meta}
+    node_ids = list(campaign.graph_nodes.keys())
+    campaign.graph = nx.Graph()
+    campaign.graph.add_nodes_from(node_ids)
+    for _ in range(n_nodes):
+        a, b = rng.sample(node_ids, 2)
+        campaign.graph.add_edge(a, b)
+    campaign.graph_edges = {f"{a}_{b}": {"source": a, "dest": b, "verb": rng.choice(VERBS)} for a, b in campaign.graph.edges()}
+    return campaign
+
+
+def synthetic_alignment(rng: random.Random, campaign: Campaign):
+    """ a procedure of 2 to 4 nodes and the candidates node_alignment could give for it:
+        k_list, v_list sorted by similarity (or [-1]) and node_matrix
+    """
+    procedure = Procedure()
+    procedure.id = "synthetic"
+    procedure.graph_nodes = dict()
+    for i in range(rng.randint(2, 4)):
+        meta = {"label": rng.choice(LABELS), "text": f"procedure phrase {i}"}
+        if rng.random() < 0.5:
+            meta["verbs"] = rng.sample(VERBS, rng.randint(1, 2))
+        procedure.graph_nodes[i] = {"id": i, "meta": meta}
+    node_ids = list(procedure.graph_nodes.keys())
+    procedure.graph_edges = dict()
+    for a, b in itertools.combinations(node_ids, 2):
+        if rng.random() < 0.6:
+            procedure.graph_edges[f"{a}_{b}"] = {"source": a, "dest": b, "verb": rng.choice(VERBS)}
+    # an edge whose dest was removed from the nodes is skipped
+    procedure.graph_edges["0_removed"] = {"source": 0, "dest": "removed", "verb": "use"}
+    campaign_nodes = list(campaign.graph_nodes.keys())
+    node_matrix = dict()
+    node_alignment = dict()
+    for k in node_ids:
+        if rng.random() < 0.15:
+            node_matrix[k] = dict()
+            node_alignment[k] = [-1]
+            continue
+        candidates = [(c, rng.choice(SIMILARITIES)) for c in rng.sample(campaign_nodes, rng.randint(1, min(5, len(campaign_nodes))))]
+        node_matrix[k] = dict(candidates)
+        node_alignment[k] = sorted(candidates, key=lambda x: x[1], reverse=True)
+    return procedure, list(node_alignment.keys()), list(node_alignment.values()), node_matrix
+
+
+def product_search(campaign: Campaign, procedure: Procedure, k_list: list, v_list: list, node_matrix: dict):
+    """ the itertools.product loop of graph_alignment before the combination search, edges scored by Alignment._edge_score
+    """
+    campaign_index = CampaignIndex.get(campaign)
+    all_result = []
+    edge_alignment = {}
+    max_value = 0.0
+    max_combination = None
+    for c in itertools.product(*v_list):
+        _mapper = {k_list[i]: None if c[i] == -1 else c[i] for i in range(len(k_list))}
+        for k, v in procedure.graph_edges.items():
+            if v["source"] not in procedure.graph_nodes or v["dest"] not in procedure.graph_nodes:
+                continue
+            if _mapper[v["source"]] is None or _mapper[v["dest"]] is None:
+                edge_alignment[k] = 0.0
+                continue
+            campaign_source = _mapper[v["source"]][0]
+            campaign_dest = _mapper[v["dest"]][0]
+            verb_similarity = Alignment._edge_verb_similarity(campaign_index, procedure, Alignment._edge_verbs(procedure, v), campaign_dest)
+            edge_alignment[k] = Alignment._edge_score(campaign_index, procedure, v, campaign_source, campaign_dest, node_matrix, verb_similarity)
+        _sub_graph_similarity = Alignment._sub_graph_alligment_score(_mapper, edge_alignment, procedure)
+        if _sub_graph_similarity >= 1.0:
+            _sub_graph_similarity = 1.0
+        if _sub_graph_similarity >= max_value:
+            max_value = _sub_graph_similarity
+            max_combination = _mapper
+            temp_mapper = {k:v for k,v in _mapper.items() if not (len(procedure.graph_nodes[k]["meta"]["label"])==1 and "ACTOR" in procedure.graph_nodes[k]["meta"]["label"])}
+            if _sub_graph_similarity > Keys.MATCHING_THRESHOLD:
+                all_result.append((_sub_graph_similarity,temp_mapper, _mapper))
+    return max_value, max_combination, all_result
+
+
+@pytest.mark.parametrize("threshold", [0.8, 0.3])
+@pytest.mark.parametrize("batch_size", [0, 1, 7, 4096])
+@pytest.mark.parametrize("seed", range(40))
+def test_combination_search_matches_product_loop(monkeypatch, seed, batch_size, threshold):
+    monkeypatch.setattr(Keys, "ALIGNMENT_BATCH_SIZE", batch_size)
+    monkeypatch.setattr(Keys, "MATCHING_THRESHOLD", threshold)
+    rng = random.Random(seed)
+    campaign = synthetic_campaign(rng, rng.randint(4, 12))
+    procedure, k_list, v_list, node_matrix = synthetic_alignment(rng, campaign)
+    combinations = 1
+    for v in v_list:
+        combinations *= len(v)
+    # the loop stops after ALIGNMENT_MAX_COMBINATIONS evaluated combinations, the search after as many unpruned ones
+    assert combinations <= Keys.ALIGNMENT_MAX_COMBINATIONS
+    expected = product_search(campaign, procedure, k_list, v_list, node_matrix)
+    result = Alignment._combination_search(campaign, procedure, k_list, v_list, node_matrix, CampaignIndex.get(campaign))
+    if expected[0] > Keys.MATCHING_THRESHOLD:
+        # same best value and combination, ties resolved the same way, and the same recorded results in the same order
+        assert result == expected
+    else:
+        # alignment_ records nothing below MATCHING_THRESHOLD, the search stops raising the max once one is recorded
+        assert result[0] <= expected[0] and result[1] is not None and result[2] == []
+
+
+def test_combination_search_needs_actor_distance_of_one(monkeypatch):
+    monkeypatch.setattr(Keys, "ACTOR_TOLERATE_DISTANCE", 0.5)
+    rng = random.Random(0)
+    campaign = synthetic_campaign(rng, 6)
+    procedure, k_list, v_list, node_matrix = synthetic_alignment(rng, campaign)
+    with pytest.raises(AssertionError):
+        Alignment._combination_search(campaign, procedure, k_list, v_list, node_matrix, CampaignIndex.get(campaign))
@@ -0,0 +1,25 @@
+import pickle
+import numpy as np
+from classes.cosine_similarity import CosineSimilarity
+
+
+def test_store_grows_in_amortized_copies():
+    store = CosineSimilarity(dtype = "float32")
+    buffer, copies = None, 0
+    expected = dict()
+    # one new phrase pair at a time, as procedure_deduplication adds them
+    for i in range(300):
+        value = (i % 97) / 97
+        store.add(f"procedure {i}", f"campaign {i // 2}", value)
+        expected[(f"procedure {i}", f"campaign {i // 2}")] = value
+        if store.buffer is not buffer:
+            buffer, copies = store.buffer, copies + 1
+        assert store.matrix.shape == (len(store.rows), len(store.cols))
+    # the matrix is copied a logarithmic number of times, not once per new phrase
+    assert copies < 30
+    for (procedure_phrase, campaign_phrase), value in expected.items():
+        assert store.getf1(procedure_phrase, campaign_phrase) == np.float32(value)
+    # the pairs that were never computed read as 0
+    assert store.getf1("procedure 0", "campaign 100") == 0
+    copy = pickle.loads(pickle.dumps(store))
+    assert copy.buffer is None and np.array_equal(copy.matrix, store.matrix, equal_nan = True)
@@ -0,0 +1,91 @@
+import itertools
+import random
+import types
+import pytest
+from keys import Keys
+from modules import malwares
+from classes.campaign import Campaign
+from classes.procedure import Procedure
+from classes.node_index import NodeIndex
+from classes.cosine_similarity import CosineSimilarity
+from classes import alignment_multiprocessing
+from classes.alignment_multiprocessing import Alignment
+from classes.managment import Manager
+
+MALWARE = sorted(malwares)[0]
+# every single label, the label pairs whose intersection is only OTHER or holds a gated label, no label
+LABELS = [[label] for label in Keys.LABEL2ID.keys() if label != "ABSTAIN"] + [["OTHER", "DATA"], ["ACTOR", "FUNCTION"], ["FUNCTION", "DATA"], ["USER", "REGISTRY"], []]
+# plain text, the pronouns (read as "attacker"), a known malware and several texts
+TEXTS = [{"text": "tool"}, {"text": "it"}, {"text": "They"}, {"text": MALWARE}, {"text": "tool", "texts": ["tool", MALWARE]}]
+SIMILARITIES = [0.0, 0.2, 0.3, 0.5, 0.6, 0.7, 0.9, 1.0] # return values on both sides of 0.5 and 0.8
+
+
+def synthetic_nodes(paragraph):
+    """ one node per label set and text of LABELS x TEXTS
+    """
+    paragraph.id = "synthetic"
+    paragraph.replacement_mapper = dict()
+    paragraph.graph_nodes = dict()
+    for i, (labels, text) in enumerate(itertools.product(LABELS, TEXTS)):
+        meta = dict(text, label = list(labels), type = "object")
+        if "texts" in meta:
+            meta["texts"] = list(meta["texts"])
+        paragraph.graph_nodes[i] = {"id": i, "meta": meta}
+    return paragraph
+
+
+def synthetic_store(rng: random.Random, campaign: Campaign, procedure: Procedure):
+    """ a similarity store with a random value in SIMILARITIES for every procedure phrase x campaign phrase
+    """
+    store = CosineSimilarity()
+    for procedure_phrase in sorted(procedure.get_phrase_nodes().keys()):
+        for campaign_phrase in sorted(campaign.get_phrase_nodes().keys()):
+            store.add(procedure_phrase, campaign_phrase, rng.choice(SIMILARITIES))
+    return store
+
+
+@pytest.mark.parametrize("procedure_similarity", [False, True])
+@pytest.mark.parametrize("seed", range(5))
+def test_node_similarity_row_matches_scalar(monkeypatch, seed, procedure_similarity):
+    monkeypatch.setattr(Keys, "BERT_SIM_ENABLE", True)
+    campaign = synthetic_nodes(Campaign())
+    procedure = synthetic_nodes(Procedure())
+    monkeypatch.setattr(alignment_multiprocessing, "bert_similarity", synthetic_store(random.Random(seed), campaign, procedure))
+    campaign_index = NodeIndex(campaign)
+    procedure_index = NodeIndex(procedure)
+    positions = campaign_index.positions(list(campaign.graph_nodes.keys()))
+    for k, node in procedure.graph_nodes.items():
+        row = Alignment._node_similarity_row(campaign_index, positions, procedure_index, procedure_index.position[k], procedure_similarity)
+        expected = [Alignment._node_similarity_calculation(campaign_node["meta"], node["meta"], campaign, procedure, procedure_similarity) for campaign_node in campaign.graph_nodes.values()]
+        assert row.tolist() == expected, node["meta"]
+
+
+def scalar_node_alignment(campaign: Campaign, sub_graph: list, procedure: Procedure, procedure_similarity = False):
+    """ node_alignment from _node_similarity_calculation on the current nodes
+    """
+    _node_similarity_score = dict()
+    for k, node in procedure.graph_nodes.items():
+        sim_values = [min(Alignment._node_similarity_calculation(campaign.graph_nodes[c]["meta"], node["meta"], campaign, procedure, procedure_similarity), 1.0) for c in sub_graph]
+        _node_similarity_score[k] = [(c, sim_value) for c, sim_value in zip(sub_graph, sim_values) if sim_value > Keys.NODE_SIMILARITY_THRESHOLD]
+        if len(_node_similarity_score[k]) == 0:
+            _node_similarity_score[k] = [-1]
+    return _node_similarity_score
+
+
+def test_node_alignment_after_accumulation(monkeypatch):
+    monkeypatch.setattr(Keys, "BERT_SIM_ENABLE", True)
+    procedure1 = synthetic_nodes(Procedure())
+    procedure2 = synthetic_nodes(Procedure())
+    procedure1.graph_edges = dict()
+    procedure2.graph_edges = dict()
+    # both procedures use the same phrases, so the store also covers the texts procedure1 gets from procedure2
+    monkeypatch.setattr(alignment_multiprocessing, "bert_similarity", synthetic_store(random.Random(0), procedure2, procedure1))
+    sub_graph = list(procedure2.graph_nodes.keys())
+    # builds the indexes of both procedures, as procedure_similarity does in Manager.procedure_deduplication
+    Alignment.node_alignment(procedure2, sub_graph, procedure1, procedure_similarity = True)
+    n = len(sub_graph)
+    combination = {k: None if k % 4 == 0 else (sub_graph[(k * 7 + 3) % n], 1.0) for k in procedure1.graph_nodes.keys()}
+    manager = types.SimpleNamespace(procedures = {"procedure1": procedure1, "procedure2": procedure2})
+    Manager.procedure_accumulation(manager, "procedure1", "procedure2", combination)
+    node_alignment, _ = Alignment.node_alignment(procedure2, sub_graph, procedure1, procedure_similarity = True)
+    assert node_alignment == scalar_node_alignment(procedure2, sub_graph, procedure1, procedure_similarity = True)
@@ -471,4 +471,144 @@ def _track_metrics_change(original_file:str ="data/evaluation/varying_threshold.
     with open(average_file, "w") as file:
         json.dump(average, file)
     print()
+
+def _load_analyzed_procedures():
+    from classes.managment import procedures_output_file
+    from classes.procedure import Procedure
+    procedures = dict()
+    with jsonlines.open(procedures_output_file, "r") as reader:
+        for line in reader.iter():
+            procedure = Procedure()
+            procedure.from_json(json_object = line)
+            if len(procedure.graph_nodes) > 1:
+                procedures[procedure.id] = procedure
+    return procedures
+
+def quantization_accuracy_report(report_ids:list = ["Frankenstein Campaign", "thyphoon"], dtype:str = "int8", saved_file:str = "data/evaluation/quantization_report.json"):
+    """ align the reports with the full precision similarity store and with a dtype copy of it,
+        decode both with the settings of Manager.report_decoding and report the attack path differences
+    """
+    from classes.managment import campaigns_output_dir, campaigns_tech_alignment_dir, tech_json_dir
+    from classes.alignment_multiprocessing import Alignment
+    from classes.cosine_similarity import CosineSimilarity
+    from classes.big_campaign import BigCampaign
+    from classes.technique import Technique
+    import numpy as np
+    full_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH, "all.npy")
+    quantized_path = os.path.join(Keys.CONTEXT_SIMILARITY_PATH, f"all.{dtype}.npy")
+    full = CosineSimilarity.from_file(full_path)
+    quantized = full.astype(dtype)
+    quantized.to_npy(quantized_path)
+    # largest difference between the stored similarities
+    max_error = 0.0
+    rows = np.arange(len(full.rows))
+    cols = np.arange(len(full.cols))
+    for start in range(0, len(rows), 1024):
+        difference = np.abs(full._read(rows[start:start+1024], cols) - quantized._read(rows[start:start+1024], cols))
+        if np.any(~np.isnan(difference)):
+            max_error = max(max_error, float(np.nanmax(difference)))
+    report = {"dtype": dtype, "max_similarity_error": max_error,
+              "bytes": {"full": os.path.getsize(full_path), dtype: os.path.getsize(quantized_path)}, "reports": dict()}
+    procedures = _load_analyzed_procedures()
+    techniques = dict()
+    for file in os.listdir(tech_json_dir):
+        if file.endswith(".json") and file.startswith("T"):
+            technique = Technique.from_json(os.path.join(tech_json_dir, file))
+            techniques[technique.id] = technique
+    for id_ in report_ids:
+        with open(os.path.join(campaigns_tech_alignment_dir, f"{id_}.json"), "r") as file:
+            tech_alignment = json.load(file)
+        paths = dict()
+        for name, path in (("full", full_path), (dtype, quantized_path)):
+            campaign = BigCampaign()
+            campaign.from_jsonl(os.path.join(campaigns_output_dir, f"{id_}.jsonl"), id_)
+            Alignment.all_alignment_sequential_big_campaign_sequential(campaign, procedures, techniques, path)
+            mapper = json.loads(json.dumps(campaign.mapper)) # same keys as the saved procedure alignment
+            decoded = Decoder.attack_path_decoding(mapper, matching_threshold= Keys.DECODING_MATCHING_THRESHOLD, relax = Keys.DECODING_RELAXING, criteria = Keys.DECODING_CRITERIA, tech_alignment_mapper = tech_alignment, topk = Keys.DECODING_TOP_K, recode = Keys.DECODING_RECODE)
+            paths[name] = decoded[2]
+        report["reports"][id_] = {"same_path": paths["full"] == paths[dtype],
+                                  "missing": [t for t in paths["full"] if t not in paths[dtype]],
+                                  "added": [t for t in paths[dtype] if t not in paths["full"]],
+                                  "full_path": paths["full"], f"{dtype}_path": paths[dtype]}
+        print(f"{id_}: same path {report['reports'][id_]['same_path']}, missing {report['reports'][id_]['missing']}, added {report['reports'][id_]['added']}")
+    print(f"{dtype} store: {report['bytes'][dtype]} bytes vs {report['bytes']['full']}, max similarity error {max_error:.4f}")
+    os.makedirs(os.path.dirname(saved_file), exist_ok=True)
+    with open(saved_file, "w") as file:
+        json.dump(report, file, indent=4)
+    return report
+
+def alignment_benchmark(report_ids:list = ["Frankenstein Campaign", "thyphoon"], batch_sizes:list = [0, Keys.ALIGNMENT_BATCH_SIZE], saved_file:str = "data/evaluation/alignment_benchmark.json"):
+    """ run graph_alignment of every procedure on the bundled campaign outputs once per ALIGNMENT_BATCH_SIZE (0 scores the combinations one by one),
+        check that the scores and combinations are the same as with the first size and report the time
+    """
+    import time
+    from classes.managment import campaigns_output_dir
+    import classes.alignment_multiprocessing as alignment_multiprocessing
+    from classes.alignment_multiprocessing import Alignment
+    from classes.cosine_similarity import CosineSimilarity
+    from classes.big_campaign import BigCampaign
+    alignment_multiprocessing.bert_similarity = CosineSimilarity.from_file(os.path.join(Keys.CONTEXT_SIMILARITY_PATH, "all.npy"))
+    procedures = [p for p in _load_analyzed_procedures().values() if len(p.graph_edges) > 0]
+    campaigns = list()
+    for id_ in report_ids:
+        campaign = BigCampaign()
+        campaign.from_jsonl(os.path.join(campaigns_output_dir, f"{id_}.jsonl"), id_)
+        campaigns.extend(campaign.data)
+    default_batch_size = Keys.ALIGNMENT_BATCH_SIZE
+    report = {"reports": report_ids, "procedures": len(procedures), "runs": dict()}
+    reference = None
+    for batch_size in batch_sizes:
+        Keys.ALIGNMENT_BATCH_SIZE = batch_size
+        alignment_multiprocessing.search_stats.clear()
+        results = list()
+        start = time.time()
+        for campaign in campaigns:
+            sub_graph = list(campaign.graph_nodes.keys())
+            for procedure in procedures:
+                results.append(Alignment.graph_alignment(campaign, sub_graph, procedure))
+        run = {"seconds": time.time() - start, "search": dict(alignment_multiprocessing.search_stats)}
+        if reference is None:
+            reference = run["seconds"], results
+        else:
+            run["speedup"] = reference[0] / run["seconds"]
+            run["mismatches"] = sum(1 for (value1, combination1), (value2, combination2) in zip(reference[1], results) if abs(value1 - value2) > 1e-12 or combination1 != combination2)
+        report["runs"][batch_size] = run
+        print(f"batch size {batch_size}: {run['seconds']:.2f}s " + (f"speedup {run['speedup']:.2f}x, {run['mismatches']} mismatches" if "speedup" in run else "(reference)"))
+    Keys.ALIGNMENT_BATCH_SIZE = default_batch_size
+    os.makedirs(os.path.dirname(saved_file), exist_ok=True)
+    with open(saved_file, "w") as file:
+        json.dump(report, file, indent=4)
+    return report
+
+def sentence_parse_regression(input_files:list = ["data/campaign/input/Akira.html", "data/campaign/input/macos-zuru.html"], saved_file:str = "data/evaluation/sentence_parse_regression.json"):
+    """ build the bundled reports with every sentence parsed on its own (REUSE_SENTENCE_SPANS off, Paragraph.parse_sentences) and from the spans of the paragraph parse,
+        check that the SVOs and the graphs of every chunk are the same and report the time
+    """
+    import time
+    from classes.big_campaign import BigCampaign
+    default_reuse = Keys.REUSE_SENTENCE_SPANS
+    report = {"reports": dict()}
+    for input_file in input_files:
+        id_ = os.path.splitext(os.path.basename(input_file))[0]
+        runs = dict()
+        for reuse in (False, True):
+            Keys.REUSE_SENTENCE_SPANS = reuse
+            start = time.time()
+            campaign = BigCampaign(input_file, id_)
+            # json round trip, so that tuples and lists compare the same
+            runs[reuse] = time.time() - start, [json.loads(json.dumps(c.to_dict())) for c in campaign.data]
+        reference, reused = runs[False][1], runs[True][1]
+        different = [i for i, (c1, c2) in enumerate(zip(reference, reused)) if c1 != c2]
+        report["reports"][id_] = {"chunks": len(reference), "same_chunk_count": len(reference) == len(reused), "different_chunks": different,
+                                  "seconds": {"reparse": runs[False][0], "spans": runs[True][0]}}
+        print(f"{id_}: {len(reference)} chunks, {len(different)} different, {runs[False][0]:.1f}s -> {runs[True][0]:.1f}s")
+    Keys.REUSE_SENTENCE_SPANS = default_reuse
+    os.makedirs(os.path.dirname(saved_file), exist_ok=True)
+    with open(saved_file, "w") as file:
+        json.dump(report, file, indent=4)
+    return report
+
+# quantization_accuracy_report()
+# alignment_benchmark()
+# sentence_parse_regression()
 _track_metrics_change()
\ No newline at end of file